@@ -6,14 +6,17 @@
 
 from __future__ import annotations
 
+import time
 import traceback
-from typing import TYPE_CHECKING
+from io import BytesIO
+from typing import TYPE_CHECKING, Optional
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 from .utils.colors import Colorize as C
 from .utils.logger import get_logger
+from .utils.metrics import Histogram
 
 if TYPE_CHECKING:
     from ..snake import SnakeBot
@@ -21,12 +24,102 @@ if TYPE_CHECKING:
 log = get_logger()
 
 
+# Structured log fields shared by every command event
+def command_fields(ctx: commands.Context, **kwargs) -> dict:
+    fields = dict(
+        guild=ctx.guild and ctx.guild.id,
+        channel=ctx.channel.id,
+        user=ctx.author.id,
+        command=ctx.command and ctx.command.qualified_name,
+    )
+    fields.update(kwargs)
+
+    return fields
+
+
 class Analytics(commands.Cog):
     def __init__(self, bot: SnakeBot):
         self.bot = bot
 
+        analytics_config = self.bot.config.get("Analytics", {})
+        self.retention_days = analytics_config.get("retention_days", 30)
+
+        # Stats recorded since the last flush, keyed by command name
+        self.latency: dict[str, Histogram] = {}
+        self.errors: dict[str, int] = {}
+
+        self.flush_loop.change_interval(
+            minutes=analytics_config.get("flush_minutes", 5)
+        )
+
+    async def cog_load(self):
+        self.flush_loop.start()
+
+    async def cog_unload(self):
+        self.flush_loop.cancel()
+        await self.flush()
+
+    def record(self, ctx: commands.Context, failed: bool) -> Optional[float]:
+        if (started := getattr(ctx, "started_at", None)) is None or not ctx.command:
+            return None
+
+        latency = (time.perf_counter() - started) * 1000
+        name = ctx.command.qualified_name
+
+        if (hist := self.latency.get(name)) is None:
+            hist = self.latency[name] = Histogram()
+
+        hist.observe(latency)
+
+        if failed:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+        return latency
+
+    # Write the pending window into this hour's rollup, and drop expired rollups
+    async def flush(self):
+        if not self.latency:
+            return
+
+        pending = {
+            name: (hist, self.errors.get(name, 0))
+            for name, hist in self.latency.items()
+        }
+        self.latency, self.errors = {}, {}
+
+        now = int(time.time())
+
+        try:
+            await self.bot.db.add_command_stats(now - now % 3600, pending)
+
+        except Exception as e:
+            log.error(f"Flushing command stats failed: [{type(e).__name__}]: {e}")
+
+            # Keep the window around for the next attempt
+            for name, (hist, errors) in pending.items():
+                if (current := self.latency.get(name)) is not None:
+                    hist.merge(current)
+
+                self.latency[name] = hist
+                self.errors[name] = self.errors.get(name, 0) + errors
+
+            return
+
+        if self.retention_days > 0:
+            await self.bot.db.prune_command_stats(now - self.retention_days * 86400)
+
+    @tasks.loop(minutes=5)
+    async def flush_loop(self):
+        try:
+            await self.flush()
+
+        except Exception as e:
+            log.error(f"Command stats maintenance failed: [{type(e).__name__}]: {e}")
+
     @commands.Cog.listener()
     async def on_command(self, ctx: commands.Context):
+        ctx.started_at = time.perf_counter()
+
         if ctx.guild:
             destination = f"[{ctx.guild.name} #{ctx.channel.name}]"
         else:
@@ -42,13 +135,37 @@ class Analytics(commands.Cog):
             command = ctx.invoked_with or "unknown command"
 
         log.info(
-            f"{destination}: {ctx.author.name}: {command} {' '.join(map(str, ctx.args[2:]))} {' '.join(f'{k!s}={v!r}' for k,v in ctx.kwargs.items())}"
+            f"{destination}: {ctx.author.name}: {command} {' '.join(map(str, ctx.args[2:]))} {' '.join(f'{k!s}={v!r}' for k,v in ctx.kwargs.items())}",
+            extra=command_fields(ctx, event="command", command=command),
+        )
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx: commands.Context):
+        if (latency := self.record(ctx, failed=False)) is None:
+            return
+
+        log.info(
+            f"{ctx.command and ctx.command.qualified_name} finished in {latency:.1f}ms",
+            extra=command_fields(ctx, event="command_done", latency_ms=latency),
         )
 
     @commands.Cog.listener()
     async def on_command_error(
         self, ctx: commands.Context, error: commands.CommandError
     ):
+        original = getattr(error, "original", error)
+        latency = self.record(ctx, failed=True)
+
+        log.info(
+            f"{ctx.invoked_with} failed: [{type(original).__name__}]: {original}",
+            extra=command_fields(
+                ctx,
+                event="command_error",
+                latency_ms=latency,
+                error=type(original).__name__,
+            ),
+        )
+
         if isinstance(error, commands.NoPrivateMessage):
             await ctx.send(
                 "\N{NO ENTRY} You cannot use that command in a private channel"
@@ -91,6 +208,103 @@ class Analytics(commands.Cog):
         else:
             print(f"{C(type(error).__name__).red().bold()}: {error}")
 
+    # Per-command latency (ms) over the last few hours, including the unflushed window
+    @commands.group(
+        name="metrics", brief="command latency stats", invoke_without_command=True
+    )
+    @commands.is_owner()
+    async def metrics(self, ctx: commands.Context, hours: int = 24):
+        now = int(time.time())
+        stats = await self.bot.db.get_command_stats(
+            now - now % 3600 - (hours - 1) * 3600
+        )
+
+        for name, hist in self.latency.items():
+            if (entry := stats.get(name)) is None:
+                entry = stats[name] = (Histogram(), 0)
+
+            entry[0].merge(hist)
+            stats[name] = (entry[0], entry[1] + self.errors.get(name, 0))
+
+        if not stats:
+            await ctx.send("No commands recorded yet")
+            return
+
+        lines = [
+            f"{'command':<24} {'calls':>7} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"
+        ]
+        for name, (hist, errors) in sorted(stats.items(), key=lambda i: -i[1][0].count):
+            lines.append(
+                f"{name:<24} {hist.count:>7} {errors / hist.count:>6.1%} {hist.quantile(0.5):>8.1f} {hist.quantile(0.95):>8.1f} {hist.quantile(0.99):>8.1f} {hist.max:>8.1f}"
+            )
+
+        table = "\n".join(lines)
+
+        if len(table) > 1900:
+            await ctx.send(
+                f"*last {hours}h, latencies in ms*",
+                file=discord.File(BytesIO(table.encode()), "metrics.txt"),
+            )
+
+        else:
+            await ctx.send(f"```prolog\n{table}\n```\n*last {hours}h, latencies in ms*")
+
+    # Event loop lag, gateway latency and listener durations (ms) since startup
+    @metrics.command(name="loop", brief="event loop and listener latency")
+    @commands.is_owner()
+    async def loop_metrics(self, ctx: commands.Context):
+        monitor = self.bot.monitor
+        rows = [("loop lag", monitor.lag), ("gateway", monitor.gateway)]
+        rows.extend(sorted(monitor.listeners.items()))
+
+        lines = [
+            f"{'source':<36} {'count':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"
+        ]
+        for name, hist in rows:
+            lines.append(
+                f"{name:<36} {hist.count:>7} {hist.quantile(0.5):>8.1f} {hist.quantile(0.95):>8.1f} {hist.quantile(0.99):>8.1f} {hist.max:>8.1f}"
+            )
+
+        table = "\n".join(lines)
+        await ctx.send(
+            f"```prolog\n{table}\n```\n*latencies in ms, {monitor.stalls} stalls over {monitor.stall_threshold * 1000:.0f}ms*"
+        )
+
+    # Busiest REST routes (and the cogs calling them) over the last few minutes
+    @metrics.command(name="rest", brief="top rest routes")
+    @commands.is_owner()
+    async def rest_metrics(self, ctx: commands.Context, minutes: int = 15):
+        top = self.bot.rest.top(minutes)
+
+        if not top:
+            await ctx.send("No REST calls recorded yet")
+            return
+
+        lines = [
+            f"{'route':<48} {'cog':<10} {'calls':>6} {'err':>4} {'429':>4} {'exh':>4} {'wait':>6} {'p95':>8}"
+        ]
+        for (route, cog), stats in top[:25]:
+            lines.append(
+                f"{route:<48} {cog:<10} {stats.calls:>6} {stats.errors:>4} {stats.ratelimited:>4} {stats.exhausted:>4} {stats.retry_wait:>6.1f} {stats.latency.quantile(0.95):>8.1f}"
+            )
+
+        table = "\n".join(lines)
+        footer = f"*last {minutes}m, wait in s, p95 in ms, {self.bot.rest.global_ratelimits} global rate limits*"
+
+        if len(table) > 1900:
+            await ctx.send(
+                footer, file=discord.File(BytesIO(table.encode()), "rest.txt")
+            )
+
+        else:
+            await ctx.send(f"```prolog\n{table}\n```\n{footer}")
+
+    @metrics.command(name="flush", brief="flush pending command stats")
+    @commands.is_owner()
+    async def flush_metrics(self, ctx: commands.Context):
+        await self.flush()
+        await self.bot.post_reaction(ctx.message, success=True)
+
 
 async def setup(bot):
     await bot.add_cog(Analytics(bot))
@@ -12,20 +12,32 @@ import discord
 from discord.ext import commands
 from yarl import URL
 
-from cogs.utils.sql import (BoardMessage, Channel, Emote, EmoteBoard,
-                            PostMessage, RawBoardUser, RawMessage)
+from cogs.utils.sql import (
+    BoardMessage,
+    Channel,
+    Emote,
+    EmoteBoard,
+    PostMessage,
+    RawBoardUser,
+    RawMessage,
+)
 
 from .utils.logger import get_logger
+from .utils.monitor import timed_listener
 
 if TYPE_CHECKING:
     from ..snake import SnakeBot
 
 log = get_logger()
 
+# Display names of departed leaderboard users, resolved from their last message
+DEPARTED_NAME_CACHE = 512
+
 
 class Board(commands.Cog):
     def __init__(self, bot: SnakeBot):
         self.bot = bot
+        self.departed_names: dict[int, str] = {}
 
     @staticmethod
     def format_embed(message: discord.Message, *, reply: bool = False) -> discord.Embed:
@@ -222,6 +234,7 @@ class Board(commands.Cog):
         return len(total_reacts)
 
     @commands.Cog.listener()
+    @timed_listener
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
         post: Optional[PostMessage] = None
         message: Optional[BoardMessage] = None
@@ -293,6 +306,7 @@ class Board(commands.Cog):
                 await self.add_board_post(message)
 
     @commands.Cog.listener()
+    @timed_listener
     async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
         post: Optional[PostMessage] = None
         message: Optional[BoardMessage] = None
@@ -350,6 +364,7 @@ class Board(commands.Cog):
                     await post.post.delete()
 
     @commands.Cog.listener()
+    @timed_listener
     async def on_raw_reaction_clear(self, payload: discord.RawReactionClearEvent):
         if not payload.guild_id:
             return
@@ -361,6 +376,7 @@ class Board(commands.Cog):
                 await (await raw_post.resolve(self.bot)).delete()
 
     @commands.Cog.listener()
+    @timed_listener
     async def on_raw_reaction_clear_emoji(
         self, payload: discord.RawReactionClearEmojiEvent
     ):
@@ -436,6 +452,43 @@ class Board(commands.Cog):
                 f"Setup {channel.mention} to track {emote!s} (minimum {threshold}"
             )
 
+    # Which of `user_ids` are still in the guild, in one gateway request at most.
+    # None when that can't be known (no members intent), so nobody is looked up
+    async def find_members(
+        self, guild: discord.Guild, user_ids: list[int]
+    ) -> Optional[set[int]]:
+        members = {i for i in user_ids if guild.get_member(i)}
+        missing = [i for i in user_ids if i not in members]
+
+        if missing and not guild.chunked:
+            if not self.bot.intents.members:
+                return None
+
+            members.update(
+                m.id for m in await guild.query_members(user_ids=missing[:100])
+            )
+
+        return members
+
+    async def departed_name(self, user_id: int) -> Optional[str]:
+        if (name := self.departed_names.get(user_id)) is not None:
+            return name
+
+        if not (raw_msg := await self.bot.db.get_newest_message_by_author(user_id)):
+            return None
+
+        try:
+            name = (await raw_msg.resolve(self.bot)).author.display_name
+
+        except Exception:
+            return None
+
+        if len(self.departed_names) >= DEPARTED_NAME_CACHE:
+            del self.departed_names[next(iter(self.departed_names))]
+
+        self.departed_names[user_id] = name
+        return name
+
     @emoteboard.command(name="leaders", brief="show leaderboard")
     async def board_leaderboard(self, ctx: commands.Context, emote: Emote):
         assert ctx.guild
@@ -447,14 +500,8 @@ class Board(commands.Cog):
         async def formatter(user: RawBoardUser):
             display_name = f"<@{user.id}>"
 
-            if not (ctx.guild.get_member(user.id)):
-                if raw_msg := await self.bot.db.get_newest_message_by_author(user.id):
-                    try:
-                        display_name = (
-                            await raw_msg.resolve(self.bot)
-                        ).author.display_name
-                    except:
-                        pass
+            if members is not None and user.id not in members:
+                display_name = await self.departed_name(user.id) or display_name
 
             msg = f"{self.get_line_header(user.rank)} {display_name} | {user.total_reacts}"
 
@@ -468,6 +515,7 @@ class Board(commands.Cog):
         ]
 
         user = discord.utils.find(lambda u: u.id == ctx.author.id, leaderboard)
+        members = await self.find_members(ctx.guild, [u.id for u in leaderboard[:11]])
 
         # podium = map(formatter, leaderboard[:3])
         # tail = map(formatter, leaderboard[3:11])
@@ -512,7 +560,7 @@ class Board(commands.Cog):
             )
             return
 
-        board_user = await raw_user.resolve(self.bot)
+        board_user = await raw_user.resolve(self.bot, user)
 
         embed = discord.Embed(
             color=user.color,
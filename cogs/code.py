@@ -6,29 +6,66 @@
 
 from __future__ import annotations
 
+import asyncio
+import cProfile
+import csv
 import dis
+import gzip
 import inspect
 import os
-import subprocess
+import pstats
+import statistics
+import tempfile
+import time
 from ast import PyCF_ALLOW_TOP_LEVEL_AWAIT
+from collections import OrderedDict
 from contextlib import redirect_stderr, redirect_stdout, suppress
 from datetime import datetime, timedelta
 from functools import partial
-from io import StringIO
+from io import BytesIO, StringIO, TextIOWrapper
 from types import BuiltinFunctionType  # , FunctionType, MethodType
-from typing import TYPE_CHECKING, Any, Tuple
+from typing import TYPE_CHECKING, Any, Literal, Optional, Tuple
 
 import aiosqlite
 import discord
 import import_expression as ie
+import msgspec
 from discord.ext import commands
 
+from .utils import process
+from .utils.eval_worker import EvalWorker
 from .utils.logger import get_logger
+from .utils.prometheus import Exposition
+from .utils.repl import ReplSession, compile_cached, wrap_coro
+from .utils.sql import SQL
 
 if TYPE_CHECKING:
     from ..snake import SnakeBot
 log = get_logger()
 
+SHELL_TIMEOUT = 5 * 60
+MAX_SESSIONS = 32
+PROFILE_LINES = 40
+
+# SQL result settings
+SQL_FETCH_SIZE = 500
+SQL_MAX_ROWS = 1000
+SQL_PAGE_ROWS = 20
+SQL_PAGE_CHARS = 1700
+SQL_EXPORT_SPOOL = 4 * 1024 * 1024
+SQL_EXPORT_MAX_BYTES = 25 * 1024 * 1024
+SQL_PROGRESS_STEP = 1000
+
+# timeit limits: runs are clamped, and sampling stops once the budget (seconds) is used
+TIMEIT_MAX_RUNS = 100_000
+TIMEIT_BUDGET = 10.0
+
+# Streaming shell settings
+STREAM_TIMEOUT = 60 * 60
+STREAM_EDIT_INTERVAL = 2.5
+STREAM_TAIL_LENGTH = 1800
+STREAM_BUFFER_SIZE = 512 * 1024
+
 # Inspect function implementation source from Jishaku (https://github.com/Gorialis/jishaku)
 # Copyright (c) 2017 Devon R
 
@@ -69,11 +106,118 @@ MAGIC_OPERATOR_NAMES = [
 ]
 
 
+class SQLPages(discord.ui.View):
+    def __init__(
+        self, owner_id: int, columns: list[str], rows: list[tuple], capped: bool
+    ):
+        super().__init__(timeout=180)
+        self.owner_id = owner_id
+        self.columns = columns
+        self.rows = rows
+        self.capped = capped
+        self.page = 0
+        self.message: Optional[discord.Message] = None
+
+    def __len__(self) -> int:
+        return max(1, -(-len(self.rows) // SQL_PAGE_ROWS))
+
+    def render(self) -> str:
+        start = self.page * SQL_PAGE_ROWS
+        rows = self.rows[start : start + SQL_PAGE_ROWS]
+
+        total = f"{len(self.rows)}{'+ (capped)' if self.capped else ''}"
+        body = "\n".join("- " + ", ".join(str(item) for item in row) for row in rows)
+
+        if len(body) > SQL_PAGE_CHARS:
+            body = body[:SQL_PAGE_CHARS] + "\N{HORIZONTAL ELLIPSIS}"
+
+        return (
+            f"```md\n# Columns: {', '.join(self.columns)}\n"
+            f"# Rows {start + 1}-{start + len(rows)} of {total} (page {self.page + 1}/{len(self)})\n\n"
+            f"{body}\n```"
+        )
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.owner_id
+
+    async def on_timeout(self):
+        if self.message:
+            with suppress(discord.HTTPException):
+                await self.message.edit(view=None)
+
+    async def show(self, interaction: discord.Interaction, page: int):
+        self.page = page % len(self)
+        await interaction.response.edit_message(content=self.render(), view=self)
+
+    @discord.ui.button(emoji="\N{BLACK LEFT-POINTING TRIANGLE}")
+    async def previous_page(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="\N{BLACK RIGHT-POINTING TRIANGLE}")
+    async def next_page(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await self.show(interaction, self.page + 1)
+
+    @discord.ui.button(
+        emoji="\N{BLACK SQUARE FOR STOP}", style=discord.ButtonStyle.danger
+    )
+    async def close(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.stop()
+        await interaction.response.edit_message(view=None)
+
+
 class Code(commands.Cog):
     def __init__(self, bot: SnakeBot):
         self.bot = bot
         self.NL = "\n"
 
+        code_config = self.bot.config.get("Code", {})
+        self.use_worker = code_config.get("eval_worker", False)
+        self.worker = EvalWorker(
+            timeout=code_config.get("eval_timeout", 10.0),
+            cpu=code_config.get("eval_cpu", 5.0),
+        )
+
+        self.sessions: OrderedDict[int, ReplSession] = OrderedDict()
+
+    async def cog_unload(self):
+        await self.worker.close()
+
+    # Each channel gets its own namespace, which persists between runs
+    def get_session(self, ctx: commands.Context) -> ReplSession:
+        if (session := self.sessions.get(ctx.channel.id)) is None:
+            session = self.sessions[ctx.channel.id] = ReplSession(globals())
+
+            if len(self.sessions) > MAX_SESSIONS:
+                self.sessions.popitem(last=False)
+
+        else:
+            self.sessions.move_to_end(ctx.channel.id)
+
+        session.scope.update(
+            self=self,
+            bot=self.bot,
+            message=ctx.message,
+            guild=ctx.guild,
+            channel=ctx.channel,
+            author=ctx.author,
+            ctx=ctx,
+        )
+
+        return session
+
+    def collect_metrics(self, out: Exposition):
+        info = compile_cached.cache_info()
+
+        out.counter("snake_compile_cache_hits_total", info.hits, "Eval snippets reused")
+        out.counter(
+            "snake_compile_cache_misses_total", info.misses, "Eval snippets compiled"
+        )
+        out.gauge("snake_repl_sessions", len(self.sessions), "Open REPL sessions")
+
     # Strip formatting from codeblocks
     @staticmethod
     def clean(code):
@@ -101,7 +245,7 @@ class Code(commands.Cog):
         with redirect_stdout(stdout):
             with redirect_stderr(stderr):
                 try:
-                    compiled = ie.compile(code, "<eval>", "eval")
+                    compiled = compile_cached(code, "<eval>", "eval")
                     scope["__compiled"] = compiled
 
                     result = eval(compiled, ie.update_globals(scope))
@@ -138,7 +282,7 @@ class Code(commands.Cog):
         with redirect_stdout(stdout):
             with redirect_stderr(stderr):
                 try:
-                    compiled = ie.compile(code, "<exec>", "exec")
+                    compiled = compile_cached(code, "<exec>", "exec")
                     scope["__compiled"] = compiled
 
                     exec(compiled, ie.update_globals(scope))
@@ -175,6 +319,26 @@ class Code(commands.Cog):
             raw_result,
         )
 
+    # Utility function to run code in the worker process
+    async def do_remote(self, mode: str, code: str) -> Tuple[bool, str, Any]:
+        response = await self.worker.run(mode, code)
+
+        if response.error:
+            return True, f"```py\n{response.result}\n```", None
+
+        result_out = (o := response.stdout) and f"**+ Output +**\n```py\n{o}\n```" or ""
+        result_err = (e := response.stderr) and f"**! Error !**\n```py\n{e}\n```" or ""
+        timing = f"*{response.elapsed * 1000:.1f}ms wall, {response.cpu_time * 1000:.1f}ms cpu*"
+
+        if mode == "eval":
+            return False, f"{result_err}\n{result_out}\n{timing}", response.load()
+
+        return (
+            False,
+            f"**= Result =**\n```py\n{response.result}\n```\n{result_err}\n{result_out}\n{timing}",
+            response.load(),
+        )
+
     # Utility function to scrape information from a code result
     def get_info(self, result):
         data = repr(result)
@@ -258,21 +422,13 @@ class Code(commands.Cog):
     async def run_debug(self, ctx: commands.Context, *, code: str):
         source = self.clean(code)
 
-        scope = globals()
-        scope.update(
-            dict(
-                self=self,
-                bot=self.bot,
-                message=ctx.message,
-                guild=ctx.guild,
-                channel=ctx.channel,
-                author=ctx.author,
-                ctx=ctx,
-                __code=source,
-            )
-        )
+        scope = self.get_session(ctx).update(__code=source)
 
-        error, output, result = await self.do_eval(scope, source)
+        if self.use_worker:
+            error, output, result = await self.do_remote("eval", source)
+
+        else:
+            error, output, result = await self.do_eval(scope, source)
 
         if isinstance(result, discord.Embed):
             await ctx.send(embed=result)
@@ -288,23 +444,15 @@ class Code(commands.Cog):
     @commands.command(name="run", brief="exec mode")
     @commands.is_owner()
     async def run_exec(self, ctx: commands.Context, *, code: str):
-        source = "async def __coro():\n  " + "\n  ".join(self.clean(code).split("\n"))
-
-        scope = globals()
-        scope.update(
-            dict(
-                self=self,
-                bot=self.bot,
-                message=ctx.message,
-                guild=ctx.guild,
-                channel=ctx.channel,
-                author=ctx.author,
-                ctx=ctx,
-                __code=source,
-            )
-        )
+        source = wrap_coro(self.clean(code))
 
-        error, result, raw = await self.do_exec(scope, source)
+        scope = self.get_session(ctx).update(__code=source)
+
+        if self.use_worker:
+            error, result, raw = await self.do_remote("exec", source)
+
+        else:
+            error, result, raw = await self.do_exec(scope, source)
 
         if isinstance(raw, discord.Embed):
             await ctx.send(embed=raw)
@@ -318,8 +466,147 @@ class Code(commands.Cog):
 
         await ctx.send(result)
 
+    # Utility function to get a callable coroutine factory for a snippet
+    async def prepare_snippet(self, ctx: commands.Context, code: str):
+        source = wrap_coro(self.clean(code))
+        scope = self.get_session(ctx).update(__code=source)
+
+        try:
+            exec(compile_cached(source, "<exec>", "exec"), ie.update_globals(scope))
+
+        except SyntaxError as e:
+            await ctx.send(
+                f"```py\n{e.text}\n{'^':>{e.offset}}\n{type(e).__name__}: {e}\n```"
+            )
+            return None
+
+        return scope["__coro"]
+
+    # Run code in exec mode under cProfile
+    @commands.command(name="profile", brief="profile exec mode")
+    @commands.is_owner()
+    async def run_profile(self, ctx: commands.Context, *, code: str):
+        if not (coro := await self.prepare_snippet(ctx, code)):
+            return
+
+        # Anything else the event loop runs while this awaits is profiled too
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+
+        try:
+            profiler.enable()
+            await coro()
+
+        except BaseException as e:
+            profiler.disable()
+            await ctx.send(f"```md\n- {type(e).__name__}: {e}\n```")
+            return
+
+        profiler.disable()
+        elapsed = time.perf_counter() - started
+
+        buf = StringIO()
+        stats = pstats.Stats(profiler, stream=buf)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_LINES)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILE_LINES)
+
+        await ctx.send(
+            f"**{stats.total_calls}** calls in **{elapsed * 1000:.2f}ms**",
+            file=discord.File(BytesIO(buf.getvalue().encode()), "profile.txt"),
+        )
+
+    # Run code in exec mode repeatedly and report latency percentiles
+    @commands.command(name="timeit", brief="time exec mode")
+    @commands.is_owner()
+    async def run_timeit(
+        self, ctx: commands.Context, runs: Optional[int] = 100, *, code: str
+    ):
+        if not (coro := await self.prepare_snippet(ctx, code)):
+            return
+
+        runs = min(max(2, runs or 100), TIMEIT_MAX_RUNS)
+        warmup = max(1, runs // 10)
+        samples = []
+
+        budget = asyncio.timeout(TIMEIT_BUDGET)
+
+        try:
+            # Cancels the run in progress when the budget runs out, not just between runs
+            async with budget:
+                for _ in range(warmup):
+                    await coro()
+                    await asyncio.sleep(0)
+
+                for _ in range(runs):
+                    started = time.perf_counter_ns()
+                    await coro()
+                    samples.append((time.perf_counter_ns() - started) / 1e6)
+
+                    # Snippets that never suspend would otherwise hold the loop throughout
+                    await asyncio.sleep(0)
+
+        except BaseException as e:
+            if not budget.expired():
+                await ctx.send(f"```md\n- {type(e).__name__}: {e}\n```")
+                return
+
+        if len(samples) < 2:
+            await ctx.send(
+                f"\N{WARNING SIGN}\N{VARIATION SELECTOR-16} Only {len(samples)} run fit in the {TIMEIT_BUDGET:.0f}s budget"
+            )
+            return
+
+        stopped = (
+            len(samples) < runs and f", stopped after {TIMEIT_BUDGET:.0f}s budget" or ""
+        )
+
+        cuts = statistics.quantiles(samples, n=100)
+        summary = (
+            f"{len(samples)} runs (+{warmup} warmup{stopped})\n"
+            f"min  {min(samples):.4f}ms\n"
+            f"mean {statistics.fmean(samples):.4f}ms\n"
+            f"p50  {cuts[49]:.4f}ms\n"
+            f"p95  {cuts[94]:.4f}ms\n"
+            f"p99  {cuts[98]:.4f}ms\n"
+            f"max  {max(samples):.4f}ms"
+        )
+        raw = "\n".join(f"{sample:.6f}" for sample in samples)
+
+        await ctx.send(
+            f"```prolog\n{summary}\n```",
+            file=discord.File(
+                BytesIO(f"{summary}\n\n# samples (ms)\n{raw}\n".encode()), "timeit.txt"
+            ),
+        )
+
+    # Throw away the current channel's REPL namespace
+    @commands.command(name="reset", brief="reset repl session")
+    @commands.is_owner()
+    async def reset_session(self, ctx: commands.Context):
+        if self.sessions.pop(ctx.channel.id, None) is None:
+            await self.bot.post_reaction(ctx.message, unknown=True)
+
+        else:
+            await self.bot.post_reaction(ctx.message, success=True)
+
+    # Switch debug/run between the bot's event loop and the worker process
+    @commands.command(name="worker", brief="toggle eval worker")
+    @commands.is_owner()
+    async def toggle_worker(self, ctx: commands.Context):
+        self.use_worker = not self.use_worker
+
+        if self.use_worker:
+            await self.worker.start()
+
+        else:
+            await self.worker.close()
+
+        await ctx.send(
+            f"Running code {'in the worker process' if self.use_worker else 'on the event loop'}"
+        )
+
     # Run SQL query
-    @commands.command(name="sql", brief="execute sql")
+    @commands.group(name="sql", brief="execute sql", invoke_without_command=True)
     @commands.is_owner()
     async def run_sql(self, ctx: commands.Context, *, query: str):
         sql = self.clean(query)
@@ -327,9 +614,21 @@ class Code(commands.Cog):
         if not sql.endswith(";"):
             sql += ";"
 
+        columns = []
+        results = []
+        capped = False
+
         try:
             async with self.bot.db.conn.execute(sql) as cur:
-                results = list(await cur.fetchall())
+                columns = [col[0] for col in cur.description or ()]
+
+                while rows := await cur.fetchmany(SQL_FETCH_SIZE):
+                    results.extend(tuple(row) for row in rows)
+
+                    if len(results) >= SQL_MAX_ROWS:
+                        del results[SQL_MAX_ROWS:]
+                        capped = True
+                        break
 
             await self.bot.db.conn.commit()
 
@@ -347,10 +646,255 @@ class Code(commands.Cog):
             await self.bot.post_reaction(ctx.message, success=True)
 
         else:
-            # I'm sorry
-            result = f"```md\n# Columns: {', '.join(results[0].keys())}\n# {len(results)} total rows\n\n{self.NL.join('- ' + (', '.join(str(item) for item in tuple(arg))) for arg in results)}\n```"
+            pages = SQLPages(ctx.author.id, columns, results, capped)
+
+            if len(pages) == 1:
+                await ctx.send(pages.render())
+
+            else:
+                pages.message = await ctx.send(pages.render(), view=pages)
+
+    # Render EXPLAIN QUERY PLAN rows as a tree, like the sqlite3 shell does
+    @staticmethod
+    def format_query_plan(rows: list[tuple]) -> str:
+        children: dict[int, list[tuple[int, str]]] = {}
+        for node_id, parent, _, detail in rows:
+            children.setdefault(parent, []).append((node_id, detail))
+
+        lines = ["QUERY PLAN"]
+
+        def walk(parent: int, prefix: str):
+            nodes = children.get(parent, [])
+            for i, (node_id, detail) in enumerate(nodes):
+                last = i == len(nodes) - 1
+                lines.append(f"{prefix}{'`--' if last else '|--'}{detail}")
+                walk(node_id, prefix + ("   " if last else "|  "))
+
+        walk(0, "")
+
+        return "\n".join(lines)
+
+    # Show the query plan without running the query
+    @run_sql.command(name="explain", brief="show sql query plan")
+    @commands.is_owner()
+    async def explain_sql(self, ctx: commands.Context, *, query: str):
+        sql = self.clean(query)
+
+        try:
+            async with self.bot.db.conn.execute(f"EXPLAIN QUERY PLAN {sql}") as cur:
+                rows = [tuple(row) for row in await cur.fetchall()]
+
+        except Exception as e:
+            await ctx.send(f"```diff\n- {type(e).__name__}: {e}\n```")
+            return
+
+        await ctx.send(
+            await self.check_length(f"```\n{self.format_query_plan(rows)}\n```")
+        )
+
+    # Run a query, discarding rows, and report how long it took and how much work it did
+    @run_sql.command(name="time", brief="time sql query")
+    @commands.is_owner()
+    async def time_sql(self, ctx: commands.Context, *, query: str):
+        sql = self.clean(query)
+
+        try:
+            # A private connection, so the progress handler and status counters only
+            # see this query
+            profile = await self.bot.db.profile(sql, SQL_PROGRESS_STEP)
+
+        except Exception as e:
+            await ctx.send(f"```diff\n- {type(e).__name__}: {e}\n```")
+            return
+
+        def counter(value: Optional[int]) -> str:
+            return "n/a" if value is None else str(value)
+
+        first = (
+            "n/a" if profile.first_row is None else f"{profile.first_row * 1000:.3f}ms"
+        )
+        steps = f"{'' if profile.exact_steps else '~'}{profile.vm_steps}"
+
+        await ctx.send(
+            await self.check_length(
+                f"```prolog\n"
+                f"Wall time      = {profile.elapsed * 1000:.3f}ms\n"
+                f"First row      = {first}\n"
+                f"Rows returned  = {profile.rows}\n"
+                f"Rows changed   = {profile.changes}\n"
+                f"VM steps       = {steps}\n"
+                f"Full scan rows = {counter(profile.fullscan_steps)}\n"
+                f"Sorts          = {counter(profile.sorts)}\n"
+                f"Autoindex rows = {counter(profile.autoindex_rows)}\n"
+                f"Cache hits     = {counter(profile.cache_hits)}\n"
+                f"Cache misses   = {counter(profile.cache_misses)}\n"
+                f"```\n```\n{self.format_query_plan(profile.plan)}\n```"
+            )
+        )
+
+    # Show per-method latency for the SQL data layer
+    @run_sql.command(name="stats", brief="sql latency stats")
+    @commands.is_owner()
+    async def sql_stats(
+        self, ctx: commands.Context, action: Optional[Literal["json", "reset"]] = None
+    ):
+        if action == "reset":
+            self.bot.db.reset_stats()
+            await self.bot.post_reaction(ctx.message, success=True)
+            return
+
+        stats = self.bot.db.dump_stats()
+
+        if action == "json":
+            await ctx.send(
+                file=discord.File(
+                    BytesIO(msgspec.json.format(msgspec.json.encode(stats))),
+                    "sql_stats.json",
+                )
+            )
+            return
+
+        if not stats:
+            await ctx.send("No queries recorded yet")
+            return
+
+        lines = [
+            f"{'method':<30} {'calls':>7} {'err':>4} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"
+        ]
+        for name, stat in sorted(stats.items(), key=lambda i: -i[1]["sum"]):
+            lines.append(
+                f"{name:<30} {stat['count']:>7} {stat['errors']:>4} {stat['p50']:>8.2f} {stat['p95']:>8.2f} {stat['p99']:>8.2f} {stat['max']:>8.2f}"
+            )
+
+        await ctx.send(
+            await self.check_length(
+                f"```prolog\n{self.NL.join(lines)}\n```\n*latencies in ms*"
+            )
+        )
+
+    # Compare per-call overhead of hot lookups with Row objects against plain tuples
+    @run_sql.command(name="bench", brief="benchmark hot sql lookups")
+    @commands.is_owner()
+    async def bench_sql(self, ctx: commands.Context, runs: int = 1000):
+        # A separate instance, so the shared connection's row factory and the bot's
+        # query stats are left alone
+        db = SQL(self.bot.db.db_file, busy_timeout_ms=self.bot.db.busy_timeout_ms)
+        await db._setup()
+
+        try:
+            await self.run_bench(ctx, db, runs)
+
+        finally:
+            await db.close()
+
+    async def run_bench(self, ctx: commands.Context, db: SQL, runs: int):
+        calls = {}
+
+        async with db.conn.execute(
+            "SELECT guild_id, emote FROM boards LIMIT 1;"
+        ) as cur:
+            if row := await cur.fetchone():
+                calls["get_board"] = partial(db.get_board, *row)
+
+        async with db.conn.execute(
+            "SELECT message_id FROM board_messages LIMIT 1;"
+        ) as cur:
+            if row := await cur.fetchone():
+                calls["get_board_message"] = partial(db.get_board_message, *row)
+
+        async with db.conn.execute(
+            "SELECT guild_id, message_id, emote FROM autoroles LIMIT 1;"
+        ) as cur:
+            if row := await cur.fetchone():
+                calls["get_autorole"] = partial(db.get_autorole, *row)
+
+        if not calls:
+            await ctx.send("Nothing to benchmark, the tables are empty")
+            return
+
+        lines = [f"{'method':<20} {'Row':>10} {'tuple':>10}"]
+
+        for name, call in calls.items():
+            timings = []
+
+            for factory in (aiosqlite.Row, None):
+                db.conn.row_factory = factory
+
+                for _ in range(max(1, runs // 10)):
+                    await call()
+
+                started = time.perf_counter()
+                for _ in range(runs):
+                    await call()
+
+                timings.append((time.perf_counter() - started) / runs * 1e6)
+
+            lines.append(f"{name:<20} {timings[0]:>8.1f}us {timings[1]:>8.1f}us")
+
+        await ctx.send(f"```prolog\n{self.NL.join(lines)}\n```\n*{runs} calls each*")
+
+    # Export a full result set as a compressed attachment
+    @run_sql.command(name="export", brief="export sql result")
+    @commands.is_owner()
+    async def export_sql(
+        self, ctx: commands.Context, fmt: Literal["csv", "ndjson"], *, query: str
+    ):
+        sql = self.clean(query)
+        buf = tempfile.SpooledTemporaryFile(max_size=SQL_EXPORT_SPOOL)
+        total = 0
+
+        try:
+            with gzip.GzipFile(filename=f"result.{fmt}", mode="wb", fileobj=buf) as gz:
+                async with self.bot.db.conn.execute(sql) as cur:
+                    columns = [col[0] for col in cur.description or ()]
+
+                    if fmt == "csv":
+                        text = TextIOWrapper(gz, encoding="utf-8", newline="")
+                        writer = csv.writer(text)
+                        writer.writerow(columns)
+
+                    while rows := await cur.fetchmany(SQL_FETCH_SIZE):
+                        if fmt == "csv":
+                            writer.writerows(tuple(row) for row in rows)
+
+                        else:
+                            gz.write(
+                                b"".join(
+                                    msgspec.json.encode(dict(zip(columns, row))) + b"\n"
+                                    for row in rows
+                                )
+                            )
+
+                        total += len(rows)
+
+                    if fmt == "csv":
+                        text.flush()
+                        text.detach()
 
-            await ctx.send(await self.check_length(result))
+            size = buf.tell()
+            buf.seek(0)
+
+            if size > SQL_EXPORT_MAX_BYTES:
+                await ctx.send(
+                    f"\N{WARNING SIGN}\N{VARIATION SELECTOR-16} Export is too large ({size} bytes compressed)"
+                )
+                return
+
+            await ctx.send(
+                f"Exported **{total}** rows ({size} bytes compressed)",
+                file=discord.File(buf, f"result.{fmt}.gz"),
+            )
+
+        except aiosqlite.OperationalError as e:
+            await ctx.send(
+                f"```diff\n- {e.args[0]}\n```\n\nDouble check your query:\n```sql\n{sql}\n```"
+            )
+
+        except Exception as e:
+            await ctx.send(f"```diff\n- {type(e).__name__}: {e}\n```")
+
+        finally:
+            buf.close()
 
     # Run shell commands
     @commands.command(name="sh", brief="system terminal")
@@ -358,17 +902,7 @@ class Code(commands.Cog):
     async def run_shell(self, ctx: commands.Context, *, command: str):
         command = self.clean(command)
 
-        result = await self.bot.loop.run_in_executor(
-            None,
-            partial(
-                subprocess.run,
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                shell=True,
-                universal_newlines=True,
-            ),
-        )
+        result = await process.run_shell(command, timeout=SHELL_TIMEOUT)
 
         out_result = (
             result.stdout
@@ -381,6 +915,12 @@ class Code(commands.Cog):
             or ""
         )
 
+        if result.timed_out:
+            err_result += f"\n\N{WARNING SIGN}\N{VARIATION SELECTOR-16} Process killed after {SHELL_TIMEOUT}s"
+
+        elif result.truncated:
+            err_result += "\n\N{WARNING SIGN}\N{VARIATION SELECTOR-16} Output truncated"
+
         if len(out_result) == 0 and len(err_result) == 0:
             if result.returncode == 0:
                 await self.bot.post_reaction(ctx.message, success=True)
@@ -393,6 +933,98 @@ class Code(commands.Cog):
         else:
             await ctx.send(await self.check_length(f"{out_result}\n{err_result}"))
 
+    @staticmethod
+    def format_tail(ring: process.OutputRing, status: str) -> str:
+        tail = ring.tail(STREAM_TAIL_LENGTH)
+        skipped = ring.total - len(tail)
+
+        header = (
+            f"\x1b[30;1m... {skipped} characters above ...\x1b[0m\n" if skipped else ""
+        )
+
+        return f"```ansi\n{header}{tail}\n```\n{status}"
+
+    # Run shell commands, tailing output into a single message as it arrives
+    @commands.command(
+        name="shstream", brief="streaming system terminal", aliases=["sh+"]
+    )
+    @commands.is_owner()
+    async def run_shell_stream(self, ctx: commands.Context, *, command: str):
+        command = self.clean(command)
+        ring = process.OutputRing(STREAM_BUFFER_SIZE)
+        running = "\N{HOURGLASS WITH FLOWING SAND} Running"
+
+        message = await ctx.send(self.format_tail(ring, running))
+        proc = await process.spawn(command, shell=True, merge_stderr=True)
+
+        # Edits are decoupled from reads so chatty commands can't hit the rate limit
+        async def updater():
+            shown = 0
+            while True:
+                await asyncio.sleep(STREAM_EDIT_INTERVAL)
+
+                if ring.total != shown:
+                    shown = ring.total
+                    with suppress(discord.HTTPException):
+                        await message.edit(content=self.format_tail(ring, running))
+
+        update_task = asyncio.create_task(updater())
+        timed_out = False
+
+        try:
+            # The process can outlive its output, so waiting on it shares the deadline
+            async with asyncio.timeout(STREAM_TIMEOUT):
+                async for _, text in process.stream_process(proc):
+                    ring.write(text)
+
+                returncode = await proc.wait()
+
+        except TimeoutError:
+            timed_out = True
+            process.kill_tree(proc)
+            returncode = await proc.wait()
+
+        except asyncio.CancelledError:
+            process.kill_tree(proc)
+            raise
+
+        finally:
+            update_task.cancel()
+
+        if timed_out:
+            status = f"\N{WARNING SIGN}\N{VARIATION SELECTOR-16} Process killed after {STREAM_TIMEOUT}s"
+
+        elif returncode == 0:
+            status = "\N{WHITE HEAVY CHECK MARK} Exited with code 0"
+
+        else:
+            status = f"\N{CROSS MARK} Exited with code {returncode}"
+
+        # Spill anything that didn't fit in the message to a single paste
+        if ring.total > STREAM_TAIL_LENGTH:
+            dropped = (
+                ring.dropped and f"[{ring.dropped} earlier characters dropped]\n" or ""
+            )
+
+            try:
+                paste = await self.bot.myst_client.create_paste(
+                    filename="output.txt",
+                    content=f"{dropped}{ring.getvalue()}",
+                    expires=datetime.utcnow() + timedelta(minutes=30),
+                )
+
+            # The tail is all there is then, but the status must not stay on "Running"
+            except Exception as e:
+                log.error(
+                    f"Uploading shstream output failed: [{type(e).__name__}]: {e}"
+                )
+                status += f" \N{EM DASH} full output upload failed ({type(e).__name__}: {str(e)[:100]})"
+
+            else:
+                status += f" \N{EM DASH} full output at <{paste.url}>"
+
+        await message.edit(content=self.format_tail(ring, status))
+
     @commands.command(name="dis", brief="disassemble code")
     @commands.is_owner()
     async def disassemble_code(self, ctx: commands.Context, *, code: str):
@@ -430,19 +1062,7 @@ class Code(commands.Cog):
     async def inspect_debug(self, ctx: commands.Context, *, code: str):
         source = self.clean(code)
 
-        scope = globals()
-        scope.update(
-            dict(
-                self=self,
-                bot=self.bot,
-                message=ctx.message,
-                guild=ctx.guild,
-                channel=ctx.channel,
-                author=ctx.author,
-                ctx=ctx,
-                __code=source,
-            )
-        )
+        scope = self.get_session(ctx).update(__code=source)
 
         error, output, result = await self.do_eval(scope, source)
 
@@ -459,21 +1079,9 @@ class Code(commands.Cog):
     @inspect_group.command(name="run", brief="inspect an exec result")
     @commands.is_owner()
     async def inspect_run(self, ctx: commands.Context, *, code: str):
-        source = "async def __coro():\n  " + "\n  ".join(self.clean(code).split("\n"))
-
-        scope = globals()
-        scope.update(
-            dict(
-                self=self,
-                bot=self.bot,
-                message=ctx.message,
-                guild=ctx.guild,
-                channel=ctx.channel,
-                author=ctx.author,
-                ctx=ctx,
-                __code=source,
-            )
-        )
+        source = wrap_coro(self.clean(code))
+
+        scope = self.get_session(ctx).update(__code=source)
 
         error, result, raw = await self.do_exec(scope, source)
 
@@ -11,7 +11,6 @@ from typing import TYPE_CHECKING, Optional
 
 import discord
 from discord.ext import commands
-from PIL import Image, ImageColor
 from yarl import URL
 
 from .utils.logger import get_logger
@@ -28,6 +27,9 @@ class Images(commands.Cog):
 
     @commands.hybrid_command(name="color", brief="show color swatch")
     async def get_color(self, ctx: commands.Context, *, color: str):
+        # Pillow is only needed here, so it isn't imported until the first swatch
+        from PIL import Image, ImageColor
+
         color = color.strip("`")
         try:
             color_val = ImageColor.getrgb(color)
@@ -0,0 +1,230 @@
+# MIT License
+#
+# Copyright (c) 2016-2023 AnonymousDapper
+#
+
+
+from __future__ import annotations
+
+import asyncio
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+import discord
+from discord.ext import commands, tasks
+
+from .utils.logger import get_logger
+
+if TYPE_CHECKING:
+    from ..snake import SnakeBot
+    from .utils.cluster import IPCMessage
+
+log = get_logger()
+
+
+class Maintenance(commands.Cog):
+    def __init__(self, bot: SnakeBot):
+        self.bot = bot
+
+        db_config = self.bot.config["SQLite"]
+        self.purge_batch = db_config.get("purge_batch", 500)
+        self.needs_compact = False
+
+        self.compact_loop.change_interval(hours=db_config.get("maintenance_hours", 6))
+
+        self.backup_dir = Path(db_config.get("backup_dir", "backups"))
+        self.backup_keep = db_config.get("backup_keep", 7)
+        self.backup_compress = db_config.get("backup_compress", True)
+        self.backup_hours = db_config.get("backup_hours", 24)
+
+        if self.backup_hours > 0:
+            self.backup_loop.change_interval(hours=self.backup_hours)
+
+    # Scheduled jobs touch the whole database, so only one cluster runs them
+    async def cog_load(self):
+        if self.bot.ipc:
+            self.bot.ipc.on("guild_present")(self.on_ipc_guild_present)
+
+        if not self.bot.is_primary:
+            return
+
+        if self.bot.ipc:
+            self.bot.ipc.on("needs_compact")(self.on_ipc_needs_compact)
+
+        self.compact_loop.start()
+
+        if self.backup_hours > 0:
+            self.backup_loop.start()
+
+    async def cog_unload(self):
+        if self.bot.ipc:
+            self.bot.ipc.handlers.pop("guild_present", None)
+            self.bot.ipc.handlers.pop("needs_compact", None)
+
+        self.compact_loop.cancel()
+        self.backup_loop.cancel()
+
+    async def compact(self) -> tuple[int, int]:
+        before, after = await self.bot.db.compact()
+        self.needs_compact = False
+
+        log.info(
+            f"Compacted database: {before} -> {after} pages ({before - after} reclaimed)"
+        )
+
+        return before, after
+
+    async def purge(self, guild_id: int) -> dict[str, int]:
+        removed = await self.bot.db.purge_guild(guild_id, self.purge_batch)
+
+        if any(removed.values()):
+            # Only the primary runs compact_loop, so tell it there's work to do
+            if self.bot.is_primary:
+                self.needs_compact = True
+
+            else:
+                await self.bot.ipc.send("needs_compact", target=0)
+
+        log.info(
+            f"Purged guild {guild_id}: {', '.join(f'{n} {t}' for t, n in removed.items())}"
+        )
+
+        return removed
+
+    async def backup(self) -> tuple[Path, int]:
+        suffix = self.backup_compress and ".db.gz" or ".db"
+        path = self.backup_dir / f"snake-{time.strftime('%Y%m%d-%H%M%S')}{suffix}"
+
+        started = time.perf_counter()
+        pages = await self.bot.db.backup(path, compress=self.backup_compress)
+
+        log.info(
+            f"Backed up {pages} pages to {path} ({path.stat().st_size} bytes) in {time.perf_counter() - started:.2f}s"
+        )
+
+        self.prune_backups()
+
+        return path, pages
+
+    # Keep only the newest `backup_keep` snapshots; names sort by timestamp.
+    # In-progress (.partial/.tmp) files are left to the backup that owns them
+    def prune_backups(self):
+        if self.backup_keep <= 0:
+            return
+
+        finished = [
+            *self.backup_dir.glob("snake-*.db"),
+            *self.backup_dir.glob("snake-*.db.gz"),
+        ]
+
+        for old in sorted(finished)[: -self.backup_keep]:
+            old.unlink(missing_ok=True)
+            log.info(f"Removed old backup {old}")
+
+    async def on_ipc_needs_compact(self, message: IPCMessage):
+        self.needs_compact = True
+
+    # Only the cluster running the guild's shard answers
+    async def on_ipc_guild_present(
+        self, message: IPCMessage
+    ) -> Optional[dict[str, bool]]:
+        guild_id = message.data["guild_id"]
+
+        if self.bot.owns_guild(guild_id):
+            return dict(present=self.bot.get_guild(guild_id) is not None)
+
+    # Check every cluster, not just the shards this process runs
+    async def guild_present(self, guild_id: int) -> bool:
+        if self.bot.owns_guild(guild_id):
+            return self.bot.get_guild(guild_id) is not None
+
+        reply = await self.bot.ipc.request("guild_present", guild_id=guild_id)
+        return reply["present"]
+
+    # Only compacts after something was purged; VACUUM is too heavy to run blindly
+    @tasks.loop(hours=6)
+    async def compact_loop(self):
+        if self.needs_compact:
+            try:
+                await self.compact()
+
+            except Exception as e:
+                log.error(f"Scheduled compaction failed: [{type(e).__name__}]: {e}")
+
+    @compact_loop.before_loop
+    async def before_compact(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(hours=24)
+    async def backup_loop(self):
+        try:
+            await self.backup()
+
+        except Exception as e:
+            log.error(f"Scheduled backup failed: [{type(e).__name__}]: {e}")
+
+    @backup_loop.before_loop
+    async def before_backup(self):
+        await self.bot.wait_until_ready()
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        try:
+            await self.purge(guild.id)
+
+        except Exception as e:
+            log.error(f"Purging guild {guild.id} failed: [{type(e).__name__}]: {e}")
+
+    @commands.group(name="db", brief="database maintenance")
+    @commands.is_owner()
+    async def database(self, ctx: commands.Context):
+        ...
+
+    @database.command(name="compact", brief="vacuum and analyze the database")
+    @commands.is_owner()
+    async def compact_command(self, ctx: commands.Context):
+        async with ctx.typing():
+            before, after = await self.compact()
+
+        await ctx.send(
+            f"Compacted **{before}** -> **{after}** pages ({before - after} reclaimed)"
+        )
+
+    @database.command(name="backup", brief="snapshot the database")
+    @commands.is_owner()
+    async def backup_command(self, ctx: commands.Context):
+        async with ctx.typing():
+            path, pages = await self.backup()
+
+        await ctx.send(
+            f"Backed up **{pages}** pages to `{path}` ({path.stat().st_size} bytes)"
+        )
+
+    @database.command(name="purge", brief="remove all data for a guild")
+    @commands.is_owner()
+    async def purge_command(self, ctx: commands.Context, guild_id: int):
+        try:
+            present = await self.guild_present(guild_id)
+
+        except asyncio.TimeoutError:
+            await ctx.send(
+                "\N{WARNING SIGN}\N{VARIATION SELECTOR-16} The cluster running that guild didn't answer"
+            )
+            return
+
+        if present:
+            await ctx.send(
+                "\N{WARNING SIGN}\N{VARIATION SELECTOR-16} I'm still in that guild"
+            )
+            return
+
+        removed = await self.purge(guild_id)
+
+        await ctx.send(
+            "Removed " + ", ".join(f"**{n}** {table}" for table, n in removed.items())
+        )
+
+
+async def setup(bot):
+    await bot.add_cog(Maintenance(bot))
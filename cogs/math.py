@@ -6,8 +6,10 @@
 
 from __future__ import annotations
 
-import functools
-import subprocess
+import asyncio
+import hashlib
+import os
+from contextlib import suppress
 from pathlib import Path
 from typing import TYPE_CHECKING, Optional
 
@@ -15,7 +17,18 @@ import discord
 from discord.ext import commands
 
 from .utils.logger import get_logger
-from .utils.tex import LATEX_HEADER, Program
+from .utils.process import run_process
+from .utils.prometheus import Exposition
+from .utils.sql import RawLatexRender
+from .utils.tex import (
+    LATEX_HEADER,
+    MAX_DENSITY,
+    PDFINFO_PATH,
+    Program,
+    choose_density,
+    read_page_size,
+)
+from .utils.tex.staging import StagingManager
 
 if TYPE_CHECKING:
     from ..snake import SnakeBot
@@ -24,22 +37,38 @@ if TYPE_CHECKING:
 log = get_logger()
 
 
+# Registered once as a persistent view; render state is looked up by message ID
 class LatexMenu(discord.ui.View):
-    def __init__(self, cog: "Math", uid: int, source: str):
+    def __init__(self, cog: "Math"):
         super().__init__(timeout=None)
         self.cog = cog
-        self.uid = uid
-        self.source = source
-        self.staging_dir = Path(f"tex/staging/{uid}").resolve()
-        self.deferred = False
 
-    async def check_defer(self, interaction):
-        if not self.deferred:
-            await interaction.response.defer(ephemeral=True, thinking=True)
-            self.deferred = True
+    async def get_render(
+        self, interaction: discord.Interaction, *, image: bool = True
+    ) -> Optional[RawLatexRender]:
+        render = None
+        if interaction.message:
+            render = await self.cog.bot.db.get_latex_render(interaction.message.id)
 
-    async def render_with_theme(self, dark=False):
-        image_path = self.staging_dir / f"{self.uid}_{dark and 'dark' or 'light'}.png"
+        if render is None:
+            await interaction.response.send_message(
+                "\N{BLACK QUESTION MARK ORNAMENT} Unknown render", ephemeral=True
+            )
+
+        elif image and not Path(render.staging_path).exists():
+            await interaction.response.send_message(
+                "\N{WARNING SIGN}\N{VARIATION SELECTOR-16} This render has expired",
+                ephemeral=True,
+            )
+            return None
+
+        return render
+
+    async def render_with_theme(self, render: RawLatexRender, dark=False):
+        base_path = Path(render.staging_path)
+        image_path = base_path.with_name(
+            f"{base_path.stem}_{dark and 'dark' or 'light'}.png"
+        )
 
         if not image_path.exists():
             color = dark and "#212121" or "#f6f6f6"
@@ -50,7 +79,7 @@ class LatexMenu(discord.ui.View):
 
             await self.cog.run_program(
                 Program.Convert,
-                str(self.staging_dir / f"{self.uid}.png"),
+                str(base_path),
                 *args,
                 "-bordercolor",
                 "transparent",
@@ -71,10 +100,10 @@ class LatexMenu(discord.ui.View):
     async def get_source(
         self, interaction: discord.Interaction, button: discord.ui.Button
     ):
-        # await self.check_defer(interaction)
-        await interaction.response.send_message(
-            f"```latex\n{self.source}\n```", ephemeral=True
-        )
+        if render := await self.get_render(interaction, image=False):
+            await interaction.response.send_message(
+                f"```latex\n{render.source}\n```", ephemeral=True
+            )
 
     # @discord.ui.button(label="Redraw")
     # async def do_redraw(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -89,13 +118,12 @@ class LatexMenu(discord.ui.View):
     async def do_render_light_theme(
         self, interaction: discord.Interaction, button: discord.ui.Button
     ):
-        # await self.check_defer(interaction)
-
-        image_path = await self.render_with_theme()
+        if render := await self.get_render(interaction):
+            image_path = await self.render_with_theme(render)
 
-        await interaction.response.send_message(
-            file=discord.File(image_path), ephemeral=True
-        )
+            await interaction.response.send_message(
+                file=discord.File(image_path), ephemeral=True
+            )
 
     @discord.ui.button(
         label="Render Dark",
@@ -106,12 +134,12 @@ class LatexMenu(discord.ui.View):
     async def do_render_dark_theme(
         self, interaction: discord.Interaction, button: discord.ui.Button
     ):
-        # await self.check_defer(interaction)
-        image_path = await self.render_with_theme(dark=True)
+        if render := await self.get_render(interaction):
+            image_path = await self.render_with_theme(render, dark=True)
 
-        await interaction.response.send_message(
-            file=discord.File(image_path), ephemeral=True
-        )
+            await interaction.response.send_message(
+                file=discord.File(image_path), ephemeral=True
+            )
 
 
 class LatexRenderError(RuntimeError):
@@ -122,8 +150,24 @@ class Math(commands.Cog):
     def __init__(self, bot: SnakeBot):
         self.bot = bot
         self.COMPILE_PATH = Path("cogs/utils/tex/compile.sh").resolve()
+        self.RASTERIZE_PATH = Path("cogs/utils/tex/rasterize.sh").resolve()
 
-        self.view_msgs = []
+        tex_config = self.bot.config.get("LaTeX", {})
+        self.target_width = tex_config.get("target_width", 1600)
+
+        self.staging = StagingManager(
+            "tex/staging",
+            ttl=tex_config.get("staging_ttl_hours", 7 * 24) * 60 * 60,
+            max_bytes=tex_config.get("staging_max_mb", 256) * 1024 * 1024,
+            max_entries=tex_config.get("staging_max_renders", 2000),
+            on_collect=self.prune_renders,
+        )
+
+        self.menu = LatexMenu(self)
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.renders_in_flight = 0
 
     @staticmethod
     def clean(code):
@@ -132,25 +176,26 @@ class Math(commands.Cog):
 
         return code.strip("` \n")
 
+    # Forget renders whose staged image has been cleaned up
+    async def prune_renders(self):
+        paths = await self.bot.db.get_latex_staging_paths()
+        missing = await asyncio.to_thread(
+            lambda: [path for path in paths if not os.path.exists(path)]
+        )
+
+        if missing and (removed := await self.bot.db.remove_latex_renders(missing)):
+            log.info(f"Removed {removed} expired latex render records")
+
     async def cog_load(self):
-        await self.clean_staging_dir()
+        self.bot.add_view(self.menu)
+
+        # Clusters share the staging dir, only the primary cleans it up
+        if self.bot.is_primary:
+            self.staging.start()
 
     async def cog_unload(self):
-        for msg in self.view_msgs:
-            try:
-                await msg.edit(view=None)
-            except:
-                pass
-
-    async def clean_staging_dir(self):
-        staging_dir = Path("tex/staging").resolve()
-        subdirs = [str(p) for p in staging_dir.iterdir()]
-        if subdirs:
-            try:
-                await self.run_program(Program.Rm, "-rf", *subdirs)
-
-            except:
-                pass
+        self.menu.stop()
+        self.staging.stop()
 
     async def run_subprocess(
         self,
@@ -159,64 +204,119 @@ class Math(commands.Cog):
         *,
         timeout: Optional[int] = None,
     ):
-        command = [executable, *args]
-        log.info(f"Preparing `{' '.join(command)}`")
-
-        runner = functools.partial(
-            subprocess.run,
-            command,
-            bufsize=1,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            shell=False,
-            timeout=timeout,
-            check=True,
-            universal_newlines=True,
+        result = await run_process(
+            executable, *args, timeout=timeout, merge_stderr=True
         )
 
-        try:
-            _process = await self.bot.loop.run_in_executor(None, runner)
-
-        except subprocess.TimeoutExpired as e:
-            self.bot.log.error(f"Subprocess timed out after {e.timeout}s: `{e.cmd}`")
-            log.error(f"Subprocess timed out: {e.output}")
+        if result.timed_out:
+            self.bot.log.error(
+                f"Subprocess timed out after {timeout}s: `{result.command}`"
+            )
+            log.error(f"Subprocess timed out: {result.stdout}")
 
-            raise LatexRenderError(f"Timed out") from e
+            raise LatexRenderError(f"Timed out")
 
-        except subprocess.CalledProcessError as e:
+        if result.returncode != 0:
             self.bot.log.error(
-                f"Subprocess exited with non-zero code {e.returncode}: `{e.cmd}`"
+                f"Subprocess exited with non-zero code {result.returncode}: `{result.command}`"
+            )
+            log.error(
+                f"Subprocess exited non-zero {result.returncode}: {result.stdout}"
             )
-            log.error(f"Subprocess exited non-zero {e.returncode}: {e.output}")
 
             raise LatexRenderError(
-                f"Exited with non-zero status {e.returncode}: {e.output}"
+                f"Exited with non-zero status {result.returncode}: {result.stdout}"
             )
 
+        return result
+
     async def run_program(self, program: Program, *args: str, **kwargs):
         return await self.run_subprocess(str(program.value), args, **kwargs)
 
     async def render_latex(self, uid: str, source: str):
-        staging_dir = Path(f"tex/staging/{uid}")
+        latex = f"""{LATEX_HEADER}\n\\begin{{document}}\n{source}\n\\end{{document}}"""
 
-        await self.run_program(Program.MakeDir, "-p", str(staging_dir))
+        async with self.staging.scratch(uid) as scratch:
+            (scratch / f"{uid}.tex").write_text(latex)
 
-        latex = f"""{LATEX_HEADER}\n\\begin{{document}}\n{source}\n\\end{{document}}"""
+            await self.run_program(
+                Program.Sh, str(self.COMPILE_PATH), str(scratch), uid
+            )
+
+            density = await self.choose_density(scratch / f"{uid}.pdf")
+            await self.run_program(
+                Program.Sh, str(self.RASTERIZE_PATH), str(scratch), uid, str(density)
+            )
+
+            # Only the final image is needed by the view, the rest goes with the scratch dir
+            (image_path,) = await self.staging.keep(uid, scratch / f"{uid}.png")
+
+        # Pixel count scales with density squared, so extrapolate what MAX_DENSITY would have cost
+        with suppress(OSError):
+            size = image_path.stat().st_size
+            estimate = int(size * (MAX_DENSITY / density) ** 2)
+
+            log.info(
+                f"Rendered {uid} at {density} DPI: {size} bytes "
+                f"(estimated ~{estimate - size} bytes saved vs {MAX_DENSITY} DPI, extrapolated, not measured)"
+            )
+
+        return image_path
+
+    async def choose_density(self, pdf_path: Path) -> int:
+        info = ""
+
+        if PDFINFO_PATH:
+            with suppress(LatexRenderError):
+                info = (await self.run_program(Program.PdfInfo, str(pdf_path))).stdout
 
-        with (staging_dir / f"{uid}.tex").open("w") as f:
-            f.write(latex)
+        size = read_page_size(pdf_path, info)
 
-        await self.run_program(Program.Sh, str(self.COMPILE_PATH), uid)
+        return choose_density(size and size[0], self.target_width)
+
+    def collect_metrics(self, out: Exposition):
+        out.counter(
+            "snake_latex_cache_hits_total", self.cache_hits, "LaTeX renders reused"
+        )
+        out.counter(
+            "snake_latex_cache_misses_total",
+            self.cache_misses,
+            "LaTeX renders compiled",
+        )
+        out.gauge(
+            "snake_latex_renders_in_flight",
+            self.renders_in_flight,
+            "LaTeX renders currently compiling",
+        )
 
-        return staging_dir / f"{uid}.png"
+    def get_cache_key(self, source: str) -> str:
+        return hashlib.sha256(
+            f"{self.target_width}\n{LATEX_HEADER}\n{source}".encode()
+        ).hexdigest()
 
     @commands.hybrid_command(name="latex", brief="render latex", aliases=["tex"])
     async def latex_command(self, ctx: commands.Context, *, latex: str):
         source = self.clean(latex)
+        cache_key = self.get_cache_key(source)
         await ctx.defer()
 
         try:
-            image_path = await self.render_latex(str(ctx.message.id), source)
+            if (
+                cached := await self.bot.db.get_latex_render_by_key(cache_key)
+            ) and Path(cached.staging_path).exists():
+                self.cache_hits += 1
+                image_path = Path(cached.staging_path)
+                image_path.touch()
+
+            else:
+                self.cache_misses += 1
+                self.renders_in_flight += 1
+
+                try:
+                    image_path = await self.render_latex(str(ctx.message.id), source)
+
+                finally:
+                    self.renders_in_flight -= 1
 
             attachment = discord.File(image_path)
 
@@ -228,14 +328,26 @@ class Math(commands.Cog):
             )
 
         else:
-            self.view_msgs.append(
-                await ctx.send(
-                    f"*from **{ctx.author.display_name}***",
-                    file=attachment,
-                    view=LatexMenu(self, ctx.message.id, source),
-                    reference=ctx.message,
-                    mention_author=False,
-                )
+            # Only the components are sent, interactions go to the registered menu
+            menu = LatexMenu(self)
+            menu.stop()
+
+            message = await ctx.send(
+                f"*from **{ctx.author.display_name}***",
+                file=attachment,
+                view=menu,
+                reference=ctx.message,
+                mention_author=False,
+            )
+
+            await self.bot.db.add_latex_render(
+                message.id,
+                message.channel.id,
+                ctx.author.id,
+                hashlib.sha256(source.encode()).hexdigest(),
+                cache_key,
+                str(image_path),
+                source,
             )
 
 
@@ -14,6 +14,7 @@ from discord.ext import commands
 from cogs.utils.sql import Emote, ResolveError
 
 from .utils.logger import get_logger
+from .utils.monitor import timed_listener
 
 if TYPE_CHECKING:
     from ..snake import SnakeBot
@@ -26,6 +27,7 @@ class Roles(commands.Cog):
         self.bot = bot
 
     @commands.Cog.listener()
+    @timed_listener
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
         if (not payload.guild_id) or payload.member and payload.member.bot:
             return
@@ -52,6 +54,7 @@ class Roles(commands.Cog):
                 pass
 
     @commands.Cog.listener()
+    @timed_listener
     async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
         if (not payload.guild_id) or payload.member and payload.member.bot:
             return
@@ -0,0 +1,419 @@
+# MIT License
+#
+# Copyright (c) 2016-2023 AnonymousDapper
+#
+
+# Multi-process clustering
+#
+# The launcher (`snake.py --cluster`) splits the shard range across worker processes,
+# each running an AutoShardedBot over its own shard IDs. Workers talk to each other
+# through the launcher over a unix socket, using the same length-prefixed msgpack
+# framing as the eval worker. Cluster 0 is the primary and owns the shared
+# maintenance jobs (database compaction/backups, LaTeX staging cleanup).
+
+from __future__ import annotations
+
+__all__ = (
+    "LAUNCHER",
+    "ClusterInfo",
+    "IPCMessage",
+    "IPCClient",
+    "IPCServer",
+    "ClusterLauncher",
+    "shard_ranges",
+)
+
+import asyncio
+import os
+import signal
+import struct
+import sys
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Optional
+
+import aiohttp
+import msgspec
+
+from .logger import get_console_logger
+
+log = get_console_logger("snake.cluster")
+
+HEADER = struct.Struct(">I")
+
+# Target ID addressing the launcher itself
+LAUNCHER = -1
+
+# Restart backoff for crashed workers (seconds)
+RESTART_DELAY = 5.0
+MAX_RESTART_DELAY = 60.0
+
+
+class ClusterInfo(msgspec.Struct):
+    id: int
+    shard_ids: list[int]
+    shard_count: int
+    ipc_path: str
+
+
+class IPCMessage(msgspec.Struct, omit_defaults=True):
+    op: str
+    sender: int
+    # None goes to every other cluster
+    target: Optional[int] = None
+    data: dict[str, Any] = msgspec.field(default_factory=dict)
+
+
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder(IPCMessage)
+
+
+async def _read_message(reader: asyncio.StreamReader) -> IPCMessage:
+    (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return _decoder.decode(await reader.readexactly(size))
+
+
+async def _write_message(writer: asyncio.StreamWriter, message: IPCMessage):
+    data = _encoder.encode(message)
+    writer.write(HEADER.pack(len(data)) + data)
+    await writer.drain()
+
+
+# Split shard IDs into `clusters` contiguous, nearly equal ranges
+def shard_ranges(shard_count: int, clusters: int) -> list[list[int]]:
+    clusters = max(1, min(clusters, shard_count))
+    size, extra = divmod(shard_count, clusters)
+
+    ranges = []
+    start = 0
+
+    for i in range(clusters):
+        end = start + size + (i < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+
+    return ranges
+
+
+# => launcher side
+
+
+class IPCServer:
+    def __init__(self, path: str, on_message: Callable[[IPCMessage], Awaitable[None]]):
+        self.path = path
+        self.on_message = on_message
+        self.clients: dict[int, asyncio.StreamWriter] = {}
+
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+        self._server = await asyncio.start_unix_server(self._handle, self.path)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+        for writer in self.clients.values():
+            writer.close()
+
+        self.clients.clear()
+
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        cluster_id = None
+
+        try:
+            while True:
+                message = await _read_message(reader)
+
+                if message.op == "hello":
+                    cluster_id = message.sender
+                    self.clients[cluster_id] = writer
+                    continue
+
+                await self.route(message)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        except msgspec.DecodeError as e:
+            log.error(f"Bad IPC message from cluster {cluster_id}: {e}")
+
+        finally:
+            if cluster_id is not None and self.clients.get(cluster_id) is writer:
+                del self.clients[cluster_id]
+
+            writer.close()
+
+    async def route(self, message: IPCMessage):
+        if message.target == LAUNCHER:
+            await self.on_message(message)
+            return
+
+        for cluster_id, writer in tuple(self.clients.items()):
+            if cluster_id != message.sender and message.target in (None, cluster_id):
+                with suppress(ConnectionError):
+                    await _write_message(writer, message)
+
+
+class ClusterLauncher:
+    def __init__(
+        self,
+        token: str,
+        *,
+        clusters: int,
+        shard_count: int = 0,
+        socket_path: str,
+        ready_timeout: float = 120.0,
+        extra_args: list[str] | tuple[str, ...] = (),
+    ):
+        self.token = token
+        self.clusters = clusters
+        self.shard_count = shard_count
+        self.socket_path = socket_path
+        self.ready_timeout = ready_timeout
+        self.extra_args = list(extra_args)
+
+        self.server = IPCServer(socket_path, self.on_message)
+        self.processes: dict[int, asyncio.subprocess.Process] = {}
+        self.ready: dict[int, asyncio.Event] = {}
+
+        self._stopping = asyncio.Event()
+
+    # Discord's recommended shard count for this bot
+    async def fetch_shard_count(self) -> int:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(
+                "https://discord.com/api/v10/gateway/bot",
+                headers={"Authorization": f"Bot {self.token}"},
+            ) as resp:
+                resp.raise_for_status()
+                return (await resp.json())["shards"]
+
+    async def run(self):
+        shard_count = self.shard_count or await self.fetch_shard_count()
+        ranges = shard_ranges(shard_count, self.clusters)
+
+        log.info(f"Launching {len(ranges)} clusters for {shard_count} shards: {ranges}")
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stopping.set)
+
+        await self.server.start()
+        supervisors = []
+
+        try:
+            # One cluster at a time, so identifies stay within the session start limit
+            for cluster_id, shard_ids in enumerate(ranges):
+                if self._stopping.is_set():
+                    break
+
+                info = ClusterInfo(cluster_id, shard_ids, shard_count, self.socket_path)
+                self.ready[cluster_id] = asyncio.Event()
+
+                supervisors.append(asyncio.create_task(self.supervise(info)))
+
+                try:
+                    await asyncio.wait_for(
+                        self.ready[cluster_id].wait(), self.ready_timeout
+                    )
+
+                except asyncio.TimeoutError:
+                    log.warning(
+                        f"Cluster {cluster_id} not ready after {self.ready_timeout}s, continuing"
+                    )
+
+            await self._stopping.wait()
+
+        finally:
+            log.info("Stopping clusters")
+
+            for task in supervisors:
+                task.cancel()
+
+            await asyncio.gather(
+                *map(self.stop_worker, tuple(self.processes)), return_exceptions=True
+            )
+            await self.server.close()
+
+    async def start_worker(self, info: ClusterInfo) -> asyncio.subprocess.Process:
+        self.processes[info.id] = process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "snake",
+            "--cluster-id",
+            str(info.id),
+            "--shard-ids",
+            ",".join(map(str, info.shard_ids)),
+            "--shard-count",
+            str(info.shard_count),
+            "--ipc",
+            info.ipc_path,
+            *self.extra_args,
+            env={**os.environ, "SNAKE_LOG_NAME": f"snake-cluster{info.id}"},
+        )
+
+        log.info(
+            f"Started cluster {info.id} (pid {process.pid}) for shards {info.shard_ids}"
+        )
+        return process
+
+    async def stop_worker(self, cluster_id: int):
+        if (process := self.processes.pop(cluster_id, None)) is None:
+            return
+
+        if process.returncode is None:
+            process.terminate()
+
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+    # Keep a cluster running, restarting it with backoff if it dies
+    async def supervise(self, info: ClusterInfo):
+        delay = RESTART_DELAY
+
+        while not self._stopping.is_set():
+            process = await self.start_worker(info)
+            returncode = await process.wait()
+
+            if self._stopping.is_set():
+                return
+
+            log.error(
+                f"Cluster {info.id} exited with code {returncode}, restarting in {delay:.0f}s"
+            )
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+
+    async def on_message(self, message: IPCMessage):
+        if message.op == "ready":
+            log.info(f"Cluster {message.sender} is ready")
+
+            if event := self.ready.get(message.sender):
+                event.set()
+
+        elif message.op == "shutdown":
+            log.info(f"Shutdown requested by cluster {message.sender}")
+            self._stopping.set()
+
+
+# => worker side
+
+
+class IPCClient:
+    def __init__(self, path: str, cluster_id: int):
+        self.path = path
+        self.cluster_id = cluster_id
+        self.handlers: dict[str, Callable[[IPCMessage], Awaitable[Any]]] = {}
+
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: dict[int, asyncio.Future[dict[str, Any]]] = {}
+        self._nonce = 0
+
+    # Handlers may return a dict, which is sent back when the message was a request
+    def on(self, op: str):
+        def decorator(func: Callable[[IPCMessage], Awaitable[Any]]):
+            self.handlers[op] = func
+            return func
+
+        return decorator
+
+    async def connect(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def send(self, op: str, *, target: Optional[int] = None, **data: Any):
+        if self._writer is None:
+            log.warning(f"IPC not connected, dropping {op!r}")
+            return
+
+        try:
+            await _write_message(
+                self._writer, IPCMessage(op, self.cluster_id, target, data)
+            )
+
+        except ConnectionError as e:
+            log.warning(f"IPC send of {op!r} failed: {e}")
+
+    # Send a request and wait for the first reply; clusters with nothing to say stay quiet
+    async def request(
+        self,
+        op: str,
+        *,
+        target: Optional[int] = None,
+        timeout: float = 5.0,
+        **data: Any,
+    ) -> dict[str, Any]:
+        self._nonce += 1
+        nonce = self._nonce
+        self._pending[nonce] = future = asyncio.get_running_loop().create_future()
+
+        try:
+            await self.send(op, target=target, nonce=nonce, **data)
+            return await asyncio.wait_for(future, timeout)
+
+        finally:
+            self._pending.pop(nonce, None)
+
+    async def _dispatch(self, handler, message: IPCMessage):
+        try:
+            reply = await handler(message)
+
+        except Exception as e:
+            log.error(
+                f"IPC handler for {message.op!r} failed: [{type(e).__name__}]: {e}"
+            )
+            return
+
+        if reply is not None and (nonce := message.data.get("nonce")) is not None:
+            await self.send("reply", target=message.sender, nonce=nonce, **reply)
+
+    async def _run(self):
+        delay = 1.0
+
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                await _write_message(self._writer, IPCMessage("hello", self.cluster_id))
+                delay = 1.0
+
+                while True:
+                    message = await _read_message(reader)
+
+                    if message.op == "reply":
+                        future = self._pending.get(message.data.get("nonce"))
+
+                        if future is not None and not future.done():
+                            future.set_result(message.data)
+
+                    elif handler := self.handlers.get(message.op):
+                        asyncio.create_task(self._dispatch(handler, message))
+
+            except (OSError, asyncio.IncompleteReadError) as e:
+                log.warning(f"IPC connection lost ({e}), retrying in {delay:.0f}s")
+
+            self._writer = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
@@ -0,0 +1,253 @@
+# MIT License
+#
+# Copyright (c) 2016-2023 AnonymousDapper
+#
+
+# Out-of-process evaluation for the debug/run commands
+#
+# The worker is a long-lived child process speaking length-prefixed msgpack over
+# its stdin/stdout, so snippets can burn CPU without stalling the bot's event loop.
+# This module is also the child's entry point, and deliberately avoids importing
+# the logger (the child must not touch the bot's log files).
+
+from __future__ import annotations
+
+__all__ = ("EvalRequest", "EvalResponse", "EvalWorker")
+
+import asyncio
+import inspect
+import math
+import os
+import pickle
+import resource
+import signal
+import struct
+import sys
+import time
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+from typing import Any, BinaryIO, Optional
+
+import import_expression as ie
+import msgspec
+
+HEADER = struct.Struct(">I")
+
+
+class EvalRequest(msgspec.Struct):
+    mode: str
+    code: str
+    timeout: float
+    cpu: float
+
+
+class EvalResponse(msgspec.Struct):
+    error: bool
+    result: str
+    stdout: str = ""
+    stderr: str = ""
+    elapsed: float = 0.0
+    cpu_time: float = 0.0
+    payload: Optional[bytes] = None
+
+    # Get the actual result object if it survived pickling, else its repr
+    def load(self) -> Any:
+        if self.payload is not None:
+            try:
+                return pickle.loads(self.payload)
+
+            except Exception:
+                pass
+
+        return self.result
+
+
+_encoder = msgspec.msgpack.Encoder()
+_request_decoder = msgspec.msgpack.Decoder(EvalRequest)
+_response_decoder = msgspec.msgpack.Decoder(EvalResponse)
+
+
+class EvalWorker:
+    def __init__(self, *, timeout: float = 10.0, cpu: float = 5.0):
+        self.timeout = timeout
+        self.cpu = cpu
+
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._proc is not None and self._proc.returncode is None
+
+    async def start(self):
+        if self.running:
+            return
+
+        self._proc = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "cogs.utils.eval_worker",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+
+    async def close(self):
+        if self._proc is None:
+            return
+
+        if self._proc.returncode is None:
+            try:
+                os.killpg(self._proc.pid, signal.SIGKILL)
+
+            except ProcessLookupError:
+                pass
+
+            await self._proc.wait()
+
+        self._proc = None
+
+    async def run(self, mode: str, code: str) -> EvalResponse:
+        async with self._lock:
+            await self.start()
+            assert self._proc and self._proc.stdin and self._proc.stdout
+
+            data = _encoder.encode(EvalRequest(mode, code, self.timeout, self.cpu))
+            self._proc.stdin.write(HEADER.pack(len(data)) + data)
+
+            try:
+                await self._proc.stdin.drain()
+
+                # The child enforces its own budget, this only catches a wedged worker
+                async with asyncio.timeout(self.timeout + 5):
+                    (size,) = HEADER.unpack(
+                        await self._proc.stdout.readexactly(HEADER.size)
+                    )
+                    return _response_decoder.decode(
+                        await self._proc.stdout.readexactly(size)
+                    )
+
+            # Half a response may be left in the pipe, so the worker can't be reused
+            except asyncio.CancelledError:
+                await asyncio.shield(self.close())
+                raise
+
+            except TimeoutError:
+                await self.close()
+                return EvalResponse(True, f"Worker killed after {self.timeout + 5}s")
+
+            except (asyncio.IncompleteReadError, ConnectionError):
+                returncode = self._proc.returncode
+                await self.close()
+                return EvalResponse(True, f"Worker died (exit code {returncode})")
+
+
+# => child side
+
+
+class BudgetExceeded(BaseException):
+    ...
+
+
+def _on_budget(signum, frame):
+    raise BudgetExceeded("CPU" if signum == signal.SIGXCPU else "time")
+
+
+def _cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _evaluate(scope: dict, request: EvalRequest) -> EvalResponse:
+    stdout, stderr = StringIO(), StringIO()
+    started, cpu_started = time.perf_counter(), _cpu_time()
+
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(
+        resource.RLIMIT_CPU, (math.ceil(cpu_started + request.cpu), hard)
+    )
+    signal.setitimer(signal.ITIMER_REAL, request.timeout)
+
+    error = False
+
+    try:
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            if request.mode == "eval":
+                result = eval(
+                    ie.compile(request.code, "<eval>", "eval"), ie.update_globals(scope)
+                )
+
+            else:
+                exec(
+                    ie.compile(request.code, "<exec>", "exec"), ie.update_globals(scope)
+                )
+                result = scope["__coro"]()
+
+            if inspect.isawaitable(result):
+
+                async def _await():
+                    return await result
+
+                result = asyncio.run(_await())
+
+    except SyntaxError as e:
+        error = True
+        result = f"{e.text}\n{'^':>{e.offset}}\n{type(e).__name__}: {e}"
+
+    except BudgetExceeded as e:
+        error = True
+        result = f"BudgetExceeded: {e} budget used up"
+
+    except BaseException as e:
+        error = True
+        result = f"{type(e).__name__}: {e}"
+
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        resource.setrlimit(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, hard))
+
+    payload = None
+    if not error:
+        try:
+            payload = pickle.dumps(result)
+
+        except Exception:
+            pass
+
+    return EvalResponse(
+        error,
+        result if error else repr(result),
+        stdout.getvalue(),
+        stderr.getvalue(),
+        time.perf_counter() - started,
+        _cpu_time() - cpu_started,
+        payload,
+    )
+
+
+def _serve(channel_in: BinaryIO, channel_out: BinaryIO):
+    scope: dict[str, Any] = {"__name__": "__eval__"}
+
+    while header := channel_in.read(HEADER.size):
+        (size,) = HEADER.unpack(header)
+        request = _request_decoder.decode(channel_in.read(size))
+
+        data = _encoder.encode(_evaluate(scope, request))
+        channel_out.write(HEADER.pack(len(data)) + data)
+        channel_out.flush()
+
+
+def main():
+    signal.signal(signal.SIGXCPU, _on_budget)
+    signal.signal(signal.SIGALRM, _on_budget)
+
+    # Keep a private handle on the pipe, so stray writes to fd 1 can't corrupt it
+    channel_out = os.fdopen(os.dup(1), "wb")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    _serve(sys.stdin.buffer, channel_out)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,20 @@
 # Copyright (c) 2016-2023 AnonymousDapper
 #
 
-__all__ = "get_logger", "set_level"
+__all__ = "get_logger", "set_level", "dropped_records", "enable_structured"
 
-import inspect
+import atexit
+import gzip
 import logging
 import os
+import queue
+import shutil
+import sys
+import time
 from logging import handlers
+from typing import Optional
+
+import msgspec
 
 # Make sure the log directory exists (and create it if not)
 if not os.path.exists("logs"):
@@ -16,6 +24,9 @@ if not os.path.exists("logs"):
 
 LOG_LEVEL = logging.INFO
 
+# Records waiting for the writer thread; past this, new records are dropped instead
+LOG_QUEUE_SIZE = 10000
+
 
 class ConsoleFormatter(logging.Formatter):
     COLORS = (
@@ -41,20 +52,195 @@ class ConsoleFormatter(logging.Formatter):
         return formatter.format(record)
 
 
+# Cluster workers each write their own files (set by the launcher)
+LOG_NAME = os.environ.get("SNAKE_LOG_NAME", "snake")
+
 # Handlers
 FILE_HANDLER = handlers.RotatingFileHandler(
-    filename="logs/snake.log", maxBytes=1 * 1024 * 1024, backupCount=3
+    filename=f"logs/{LOG_NAME}.log", maxBytes=1 * 1024 * 1024, backupCount=3
 )  # Max size of 1Mb per-file, with 3 past files
 FILE_FORMATTER = logging.Formatter(
     "%(asctime)s %(levelname)s | [%(module)s.%(funcName)s()] (%(filename)s:%(lineno)s)\n\t| %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 STREAM_HANDLER = logging.StreamHandler()
+SEVERE_STREAM_HANDLER = logging.StreamHandler()
 
 
 FILE_HANDLER.setLevel(logging.NOTSET)
 FILE_HANDLER.setFormatter(FILE_FORMATTER)
 STREAM_HANDLER.setFormatter(ConsoleFormatter())
+SEVERE_STREAM_HANDLER.setLevel(logging.ERROR)
+SEVERE_STREAM_HANDLER.setFormatter(ConsoleFormatter())
+
+
+# One NDJSON line; the optional fields come from `extra=` on the logging call
+class LogEntry(msgspec.Struct, omit_defaults=True):
+    ts: float
+    level: str
+    logger: str
+    func: str
+    line: int
+    msg: str
+    event: Optional[str] = None
+    guild: Optional[int] = None
+    channel: Optional[int] = None
+    user: Optional[int] = None
+    command: Optional[str] = None
+    latency_ms: Optional[float] = None
+    error: Optional[str] = None
+
+
+STRUCTURED_FIELDS = (
+    "event",
+    "guild",
+    "channel",
+    "user",
+    "command",
+    "latency_ms",
+    "error",
+)
+
+
+class StructuredFormatter(logging.Formatter):
+    encoder = msgspec.json.Encoder()
+
+    def format(self, record):
+        return self.encoder.encode(
+            LogEntry(
+                record.created,
+                record.levelname,
+                record.name,
+                record.funcName,
+                record.lineno,
+                record.getMessage(),
+                **{name: getattr(record, name, None) for name in STRUCTURED_FIELDS},
+            )
+        ).decode()
+
+
+def _gzip_rotate(source: str, dest: str):
+    # Another process sharing the file may have rotated it already
+    try:
+        f = open(source, "rb")
+
+    except FileNotFoundError:
+        return
+
+    with f, gzip.open(dest, "wb") as out:
+        shutil.copyfileobj(f, out)
+
+    try:
+        os.remove(source)
+
+    except FileNotFoundError:
+        pass
+
+
+# Rolls over on size or age, whichever comes first, gzipping the old segments
+class RollingFileHandler(handlers.RotatingFileHandler):
+    def __init__(
+        self, filename: str, *, max_bytes: int, interval: float, backup_count: int
+    ):
+        super().__init__(
+            filename, maxBytes=max_bytes, backupCount=backup_count, delay=True
+        )
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+
+        self.namer = lambda name: f"{name}.gz"
+        self.rotator = _gzip_rotate
+
+    def shouldRollover(self, record):
+        if self.interval > 0 and time.time() >= self.rollover_at:
+            return True
+
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+# Never waits on a full queue; the record is counted and thrown away instead
+class DroppingQueueHandler(handlers.QueueHandler):
+    def __init__(self, queue: queue.Queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    # The traceback gets flattened into the message, keep its class for structured output
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info and record.exc_info[0] and not hasattr(record, "error"):
+            record.error = record.exc_info[0].__name__
+
+        return super().prepare(record)
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+
+        except queue.Full:
+            self.dropped += 1
+
+
+class BlockingStopListener(handlers.QueueListener):
+    # The stock sentinel uses put_nowait, which fails if the queue is full at exit
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+# Loggers only hand records to a queue, the listener thread does all file/console I/O
+def _make_route(
+    *targets: logging.Handler,
+) -> tuple[DroppingQueueHandler, BlockingStopListener]:
+    record_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = BlockingStopListener(record_queue, *targets, respect_handler_level=True)
+
+    listener.start()
+    atexit.register(listener.stop)
+
+    return DroppingQueueHandler(record_queue), listener
+
+
+# Reloading this module must not leave the previous writer threads running
+for _listener in (globals().get("MODULE_LISTENER"), globals().get("CONSOLE_LISTENER")):
+    if _listener is not None:
+        atexit.unregister(_listener.stop)
+        _listener.stop()
+
+        for _handler in _listener.handlers:
+            _handler.close()
+
+MODULE_HANDLER, MODULE_LISTENER = _make_route(FILE_HANDLER, SEVERE_STREAM_HANDLER)
+CONSOLE_HANDLER, CONSOLE_LISTENER = _make_route(STREAM_HANDLER)
+
+
+# Add NDJSON output alongside the text log (call once at init)
+def enable_structured(
+    filename: Optional[str] = None,
+    *,
+    max_bytes: int = 16 * 1024 * 1024,
+    interval: float = 24 * 60 * 60,
+    backup_count: int = 14,
+):
+    if any(isinstance(h, RollingFileHandler) for h in MODULE_LISTENER.handlers):
+        return
+
+    handler = RollingFileHandler(
+        filename or f"logs/{LOG_NAME}.ndjson",
+        max_bytes=max_bytes,
+        interval=interval,
+        backup_count=backup_count,
+    )
+    handler.setFormatter(StructuredFormatter())
+
+    # The listener thread reads this tuple per record, so swapping it is safe
+    MODULE_LISTENER.handlers = (*MODULE_LISTENER.handlers, handler)
+
+
+# Total records lost to a full queue since startup
+def dropped_records() -> int:
+    return MODULE_HANDLER.dropped + CONSOLE_HANDLER.dropped
 
 
 # Set log level according to debug status (call once at init)
@@ -64,31 +250,32 @@ def set_level(debug=False):
     LOG_LEVEL = logging.DEBUG if debug else logging.INFO
 
 
-# Special logger that runs for each module it's called in
-def get_logger():
-    # Get name of calling module
-    call_frame = inspect.stack()[1]
-    call_module = inspect.getmodule(call_frame[0])
-    module_name = call_module.__name__
+# Attach a route at most once, replacing any left over from an older copy of this module
+def _attach(logger: logging.Logger, route: logging.Handler):
+    for handler in logger.handlers[:]:
+        if handler is not route and isinstance(handler, handlers.QueueHandler):
+            logger.removeHandler(handler)
 
-    module_logger = logging.getLogger(module_name)
-    module_logger.setLevel(LOG_LEVEL)
-    module_logger.addHandler(FILE_HANDLER)
+    if route not in logger.handlers:
+        logger.addHandler(route)
 
-    severe_stream_handler = logging.StreamHandler()
-    severe_stream_handler.setLevel(logging.ERROR)
-    severe_stream_handler.setFormatter(ConsoleFormatter())
-    module_logger.addHandler(severe_stream_handler)
 
-    del call_frame
-    del call_module
+# Special logger that runs for each module it's called in
+def get_logger(name: Optional[str] = None) -> logging.Logger:
+    # The caller's globals already know its module name, no need to inspect the stack
+    if name is None:
+        name = sys._getframe(1).f_globals.get("__name__", "snake")
+
+    module_logger = logging.getLogger(name)
+    module_logger.setLevel(LOG_LEVEL)
+    _attach(module_logger, MODULE_HANDLER)
 
     return module_logger
 
 
-def get_console_logger(name: str):
+def get_console_logger(name: str) -> logging.Logger:
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
-    logger.addHandler(STREAM_HANDLER)
+    _attach(logger, CONSOLE_HANDLER)
 
     return logger
@@ -0,0 +1,114 @@
+# MIT License
+#
+# Copyright (c) 2016-2023 AnonymousDapper
+#
+
+from __future__ import annotations
+
+__all__ = ("Histogram", "LATENCY_BUCKETS")
+
+from bisect import bisect_left
+from typing import Any, Sequence
+
+# Latency bucket upper bounds, in milliseconds
+LATENCY_BUCKETS = (
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    25.0,
+    50.0,
+    100.0,
+    250.0,
+    500.0,
+    1000.0,
+    2500.0,
+    5000.0,
+    10000.0,
+)
+
+
+# Fixed-bucket histogram; constant memory no matter how many values are observed
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "total", "max")
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    # Rebuild a histogram saved with `counts` (e.g. a SQLite rollup)
+    @classmethod
+    def from_counts(
+        cls,
+        counts: Sequence[int],
+        total: float,
+        max: float,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        hist = cls(buckets)
+
+        if len(counts) != len(hist.counts):
+            raise ValueError(
+                f"Expected {len(hist.counts)} bucket counts, got {len(counts)}"
+            )
+
+        hist.counts = list(counts)
+        hist.count = sum(counts)
+        hist.total = total
+        hist.max = max
+
+        return hist
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: Histogram):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self) -> float:
+        return self.count and self.total / self.count or 0.0
+
+    # Estimate a quantile by interpolating inside the bucket it falls in
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+
+            seen += count
+
+        return self.max
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(
+            count=self.count,
+            sum=self.total,
+            max=self.max,
+            buckets=dict(zip((*map(str, self.buckets), "+Inf"), self.counts)),
+        )
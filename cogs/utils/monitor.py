@@ -0,0 +1,155 @@
+# MIT License
+#
+# Copyright (c) 2016-2023 AnonymousDapper
+#
+
+from __future__ import annotations
+
+__all__ = ("LoopMonitor", "timed_listener")
+
+import asyncio
+import math
+import sys
+import threading
+import time
+import traceback
+from functools import wraps
+from typing import TYPE_CHECKING, Any, Optional
+
+from .logger import get_logger
+from .metrics import Histogram
+
+if TYPE_CHECKING:
+    from discord.ext.commands import Bot
+
+log = get_logger()
+
+
+# Watches the event loop from two sides: a timer task measures how late it wakes up,
+# and a watchdog thread catches the loop mid-stall so the blocking stack can be logged
+class LoopMonitor:
+    def __init__(
+        self,
+        bot: Bot,
+        *,
+        interval: float = 0.5,
+        stall_threshold: float = 0.5,
+        gateway_interval: float = 30.0,
+    ):
+        self.bot = bot
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.gateway_interval = gateway_interval
+
+        # All in milliseconds
+        self.lag = Histogram()
+        self.gateway = Histogram()
+        self.listeners: dict[str, Histogram] = {}
+        self.stalls = 0
+
+        self._heartbeat = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+
+        self._task = asyncio.create_task(self._run_timer())
+        self._watchdog = threading.Thread(
+            target=self._run_watchdog,
+            args=(asyncio.get_running_loop(), threading.get_ident()),
+            name="loop-watchdog",
+            daemon=True,
+        )
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def observe_listener(self, name: str, elapsed: float):
+        if (hist := self.listeners.get(name)) is None:
+            hist = self.listeners[name] = Histogram()
+
+        hist.observe(elapsed * 1000)
+
+    async def _run_timer(self):
+        loop = asyncio.get_running_loop()
+        last_gateway = 0.0
+
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+
+            now = loop.time()
+            self.lag.observe(max(0.0, now - expected) * 1000)
+            self._heartbeat = time.monotonic()
+
+            # bot.latency only changes once per heartbeat, so sample it sparingly
+            if now - last_gateway >= self.gateway_interval:
+                last_gateway = now
+
+                if math.isfinite(latency := self.bot.latency):
+                    self.gateway.observe(latency * 1000)
+
+    def _run_watchdog(self, loop: asyncio.AbstractEventLoop, loop_thread: int):
+        stalled = False
+
+        while not self._stopped.wait(self.interval):
+            behind = time.monotonic() - self._heartbeat - self.interval
+
+            if behind < self.stall_threshold:
+                stalled = False
+                continue
+
+            # Only report each stall once, while it's still happening
+            if stalled:
+                continue
+
+            stalled = True
+            self.stalls += 1
+
+            if (frame := sys._current_frames().get(loop_thread)) is None:
+                continue
+
+            task = asyncio.current_task(loop)
+            log.warning(
+                f"Event loop stalled for {behind * 1000:.0f}ms+ in {task and task.get_name()}:\n"
+                + "".join(traceback.format_stack(frame))
+            )
+
+            del frame
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(
+            lag=self.lag.to_dict(),
+            gateway=self.gateway.to_dict(),
+            listeners={name: hist.to_dict() for name, hist in self.listeners.items()},
+            stalls=self.stalls,
+        )
+
+
+# Time a cog listener into the bot's LoopMonitor, if there is one
+def timed_listener(func):
+    name = func.__qualname__
+
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+
+        try:
+            return await func(self, *args, **kwargs)
+
+        finally:
+            if (monitor := getattr(self.bot, "monitor", None)) is not None:
+                monitor.observe_listener(name, time.perf_counter() - started)
+
+    return wrapper
@@ -0,0 +1,262 @@
+# MIT License
+#
+# Copyright (c) 2016-2023 AnonymousDapper
+#
+
+from __future__ import annotations
+
+__all__ = (
+    "ProcessResult",
+    "OutputRing",
+    "spawn",
+    "kill_tree",
+    "stream_process",
+    "run_process",
+    "run_shell",
+)
+
+import asyncio
+import codecs
+import os
+import signal
+from collections import deque
+from typing import AsyncIterator, Optional
+
+import msgspec
+
+from .logger import get_logger
+
+log = get_logger()
+
+# Output beyond this many bytes (per stream) is read and discarded
+DEFAULT_LIMIT = 1 * 1024 * 1024
+CHUNK_SIZE = 4096
+
+# After a timeout kill, how long to wait for the pipes to close (seconds). Anything
+# that escaped the process group can keep them open indefinitely
+DRAIN_TIMEOUT = 2.0
+
+
+class ProcessResult(msgspec.Struct):
+    args: tuple[str, ...]
+    returncode: int
+    stdout: str
+    stderr: str
+    timed_out: bool = False
+    truncated: bool = False
+
+    @property
+    def command(self) -> str:
+        return " ".join(self.args)
+
+
+# Fixed-capacity text buffer that keeps only the most recent output
+class OutputRing:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.total = 0
+        self._chunks: deque[str] = deque()
+        self._size = 0
+
+    @property
+    def dropped(self) -> int:
+        return self.total - self._size
+
+    def write(self, text: str):
+        self.total += len(text)
+        self._size += len(text)
+        self._chunks.append(text)
+
+        while self._size > self.capacity:
+            head = self._chunks.popleft()
+            excess = self._size - self.capacity
+
+            if len(head) > excess:
+                self._chunks.appendleft(head[excess:])
+                self._size -= excess
+
+            else:
+                self._size -= len(head)
+
+    def tail(self, length: int) -> str:
+        parts = []
+        size = 0
+
+        for chunk in reversed(self._chunks):
+            parts.append(chunk)
+            size += len(chunk)
+
+            if size >= length:
+                break
+
+        return "".join(reversed(parts))[-length:]
+
+    def getvalue(self) -> str:
+        return "".join(self._chunks)
+
+
+# Start a process in its own session, so the whole group can be killed later
+async def spawn(
+    *args: str,
+    shell: bool = False,
+    cwd: Optional[str] = None,
+    merge_stderr: bool = False,
+) -> asyncio.subprocess.Process:
+    stderr = asyncio.subprocess.STDOUT if merge_stderr else asyncio.subprocess.PIPE
+
+    if shell:
+        return await asyncio.create_subprocess_shell(
+            args[0],
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=stderr,
+            cwd=cwd,
+            start_new_session=True,
+        )
+
+    return await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=stderr,
+        cwd=cwd,
+        start_new_session=True,
+    )
+
+
+# Kill the process and anything it spawned
+def kill_tree(proc: asyncio.subprocess.Process, sig: int = signal.SIGKILL):
+    if proc.returncode is not None:
+        return
+
+    try:
+        os.killpg(proc.pid, sig)
+
+    except ProcessLookupError:
+        pass
+
+    except PermissionError:
+        proc.kill()
+
+
+# Fills `buf` in place, so output read so far survives the read being cancelled.
+# Returns whether anything past `limit` was discarded
+async def _read_bounded(
+    stream: Optional[asyncio.StreamReader], limit: int, buf: bytearray
+) -> bool:
+    truncated = False
+
+    while stream and (chunk := await stream.read(CHUNK_SIZE)):
+        if (room := limit - len(buf)) > 0:
+            buf += chunk[:room]
+
+        if len(chunk) > room:
+            truncated = True
+
+    return truncated
+
+
+# Yield (stream name, text) pairs as output arrives
+async def stream_process(
+    proc: asyncio.subprocess.Process,
+) -> AsyncIterator[tuple[str, str]]:
+    queue: asyncio.Queue[Optional[tuple[str, str]]] = asyncio.Queue(maxsize=64)
+
+    async def pump(name: str, stream: Optional[asyncio.StreamReader]):
+        decoder = _decoder()
+
+        try:
+            while stream and (chunk := await stream.read(CHUNK_SIZE)):
+                if text := decoder.decode(chunk):
+                    await queue.put((name, text))
+
+            if text := decoder.decode(b"", final=True):
+                await queue.put((name, text))
+
+        except Exception as e:
+            log.error(f"Reading {name} failed: [{type(e).__name__}]: {e}")
+
+        # Not reached on cancellation, where nobody is left waiting on the queue
+        await queue.put(None)
+
+    pumps = [
+        asyncio.create_task(pump("stdout", proc.stdout)),
+        asyncio.create_task(pump("stderr", proc.stderr)),
+    ]
+
+    try:
+        remaining = len(pumps)
+        while remaining:
+            if (item := await queue.get()) is None:
+                remaining -= 1
+
+            else:
+                yield item
+
+    finally:
+        for task in pumps:
+            task.cancel()
+
+        await asyncio.gather(*pumps, return_exceptions=True)
+
+
+def _decoder():
+    return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+async def run_process(
+    *args: str,
+    timeout: Optional[float] = None,
+    limit: int = DEFAULT_LIMIT,
+    shell: bool = False,
+    cwd: Optional[str] = None,
+    merge_stderr: bool = False,
+) -> ProcessResult:
+    log.info(f"Preparing `{' '.join(args)}`")
+
+    proc = await spawn(*args, shell=shell, cwd=cwd, merge_stderr=merge_stderr)
+
+    stdout, stderr = bytearray(), bytearray()
+    readers = asyncio.gather(
+        _read_bounded(proc.stdout, limit, stdout),
+        _read_bounded(proc.stderr, limit, stderr),
+    )
+
+    timed_out = False
+
+    try:
+        # One deadline for both: a child can close its pipes and keep running
+        async with asyncio.timeout(timeout):
+            out_trunc, err_trunc = await asyncio.shield(readers)
+            await proc.wait()
+
+    except asyncio.TimeoutError:
+        timed_out = True
+        kill_tree(proc)
+
+        try:
+            out_trunc, err_trunc = await asyncio.wait_for(readers, DRAIN_TIMEOUT)
+
+        except asyncio.TimeoutError:
+            log.warning(f"Output pipes of `{' '.join(args)}` still open after kill")
+            out_trunc = err_trunc = True
+
+        await proc.wait()
+
+    except asyncio.CancelledError:
+        kill_tree(proc)
+        readers.cancel()
+        raise
+
+    return ProcessResult(
+        args=tuple(args),
+        returncode=proc.returncode if proc.returncode is not None else -1,
+        stdout=stdout.decode("utf-8", errors="replace"),
+        stderr=stderr.decode("utf-8", errors="replace"),
+        timed_out=timed_out,
+        truncated=out_trunc or err_trunc,
+    )
+
+
+async def run_shell(command: str, **kwargs) -> ProcessResult:
+    return await run_process(command, shell=True, **kwargs)
@@ -0,0 +1,214 @@
+# MIT License
+#
+# Copyright (c) 2016-2023 AnonymousDapper
+#
+
+# Prometheus text exposition for the bot's in-process metrics
+#
+# Bot-wide sources (SQL layer, loop monitor, REST calls) are collected here; cogs can add their
+# own by defining `collect_metrics(self, out: Exposition)`, which is looked up on
+# every scrape so reloads need no registration bookkeeping.
+
+from __future__ import annotations
+
+__all__ = ("Exposition", "MetricsServer")
+
+from typing import TYPE_CHECKING, Optional
+
+from .logger import get_logger
+from .metrics import Histogram
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+    from snake import SnakeBot
+
+log = get_logger()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict[str, object]) -> str:
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+# Collects samples grouped by metric family, so HELP/TYPE are written once each
+class Exposition:
+    def __init__(self):
+        self.families: dict[str, tuple[str, str, list[str]]] = {}
+
+    def _family(self, name: str, kind: str, doc: str) -> list[str]:
+        if (family := self.families.get(name)) is None:
+            family = self.families[name] = (kind, doc, [])
+
+        return family[2]
+
+    def counter(self, name: str, value: float, doc: str, **labels: object):
+        self._family(name, "counter", doc).append(f"{name}{_labels(labels)} {value}")
+
+    def gauge(self, name: str, value: float, doc: str, **labels: object):
+        self._family(name, "gauge", doc).append(f"{name}{_labels(labels)} {value}")
+
+    # Our histograms keep per-bucket counts, Prometheus wants them cumulative
+    def histogram(self, name: str, hist: Histogram, doc: str, **labels: object):
+        samples = self._family(name, "histogram", doc)
+        seen = 0
+
+        for bound, count in zip((*map(str, hist.buckets), "+Inf"), hist.counts):
+            seen += count
+            samples.append(f"{name}_bucket{_labels(dict(labels, le=bound))} {seen}")
+
+        samples.append(f"{name}_sum{_labels(labels)} {hist.total}")
+        samples.append(f"{name}_count{_labels(labels)} {hist.count}")
+
+    def render(self) -> str:
+        lines = []
+
+        for name, (kind, doc, samples) in self.families.items():
+            lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    def __init__(self, bot: SnakeBot, *, host: str = "127.0.0.1", port: int = 9464):
+        self.bot = bot
+        self.host = host
+        self.port = port
+
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        if self._runner is not None:
+            return
+
+        # aiohttp.web is a sizeable import, and only needed when metrics are enabled
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+        log.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        from aiohttp import web
+
+        return web.Response(
+            body=self.collect().render().encode(),
+            headers={"Content-Type": CONTENT_TYPE},
+        )
+
+    def collect(self) -> Exposition:
+        out = Exposition()
+        bot = self.bot
+
+        monitor = bot.monitor
+        out.histogram(
+            "snake_loop_lag_ms", monitor.lag, "Event loop wakeup delay in milliseconds"
+        )
+        out.histogram(
+            "snake_gateway_latency_ms",
+            monitor.gateway,
+            "Gateway heartbeat latency in milliseconds",
+        )
+        out.counter(
+            "snake_loop_stalls_total",
+            monitor.stalls,
+            "Event loop stalls over the threshold",
+        )
+
+        for name, hist in monitor.listeners.items():
+            cog, _, listener = name.rpartition(".")
+            out.histogram(
+                "snake_listener_duration_ms",
+                hist,
+                "Cog listener run time in milliseconds",
+                cog=cog,
+                listener=listener,
+            )
+
+        for method, hist in bot.db.latency.items():
+            out.histogram(
+                "snake_db_query_ms",
+                hist,
+                "SQL layer call latency in milliseconds",
+                method=method,
+            )
+            out.counter(
+                "snake_db_query_errors_total",
+                bot.db.errors.get(method, 0),
+                "SQL layer calls that raised",
+                method=method,
+            )
+
+        for (route, cog), stats in bot.rest.totals.items():
+            labels = dict(route=route, cog=cog)
+
+            out.histogram(
+                "snake_rest_request_ms",
+                stats.latency,
+                "Discord REST request time in milliseconds, including rate limit waits",
+                **labels,
+            )
+            out.counter(
+                "snake_rest_errors_total",
+                stats.errors,
+                "Discord REST requests that raised",
+                **labels,
+            )
+            out.counter(
+                "snake_rest_ratelimited_total",
+                stats.ratelimited,
+                "Discord REST 429 responses",
+                **labels,
+            )
+            out.counter(
+                "snake_rest_bucket_exhausted_total",
+                stats.exhausted,
+                "Discord REST rate limit buckets used up",
+                **labels,
+            )
+            out.counter(
+                "snake_rest_retry_wait_seconds_total",
+                stats.retry_wait,
+                "Time spent sleeping on 429 retry_after",
+                **labels,
+            )
+
+        out.counter(
+            "snake_rest_global_ratelimits_total",
+            bot.rest.global_ratelimits,
+            "Discord global rate limits hit",
+        )
+
+        out.gauge("snake_guilds", len(bot.guilds), "Guilds the bot is in")
+
+        for cog in tuple(bot.cogs.values()):
+            if collect := getattr(cog, "collect_metrics", None):
+                try:
+                    collect(out)
+
+                except Exception as e:
+                    log.error(
+                        f"Collecting metrics from {type(cog).__name__} failed: [{type(e).__name__}]: {e}"
+                    )
+
+        return out
@@ -0,0 +1,123 @@
+# MIT License
+#
+# Copyright (c) 2016-2023 AnonymousDapper
+#
+
+from __future__ import annotations
+
+__all__ = ("ReplSession", "compile_cached", "wrap_coro")
+
+import ast
+import time
+from contextlib import suppress
+from functools import lru_cache
+from types import CodeType
+from typing import Any, Optional
+
+import import_expression as ie
+
+
+# Repeated snippets skip parsing and compiling entirely
+@lru_cache(maxsize=256)
+def compile_cached(source: str, filename: str, mode: str) -> CodeType:
+    return ie.compile(source, filename, mode)
+
+
+# Names a snippet binds in its own (the coroutine's) scope; nested functions, classes
+# and comprehensions get their own, except for walrus targets in comprehensions
+class _BoundNames(ast.NodeVisitor):
+    def __init__(self):
+        self.names: dict[str, None] = {}
+        self.comprehension = 0
+
+    def bind(self, name: Optional[str]):
+        if name:
+            self.names[name] = None
+
+    def visit_Name(self, node: ast.Name):
+        if not self.comprehension and isinstance(node.ctx, (ast.Store, ast.Del)):
+            self.bind(node.id)
+
+    def visit_NamedExpr(self, node: ast.NamedExpr):
+        self.bind(node.target.id)
+        self.visit(node.value)
+
+    def visit_FunctionDef(self, node: ast.FunctionDef | ast.AsyncFunctionDef):
+        self.bind(node.name)
+
+        for expr in (*node.decorator_list, *node.args.defaults, *node.args.kw_defaults):
+            if expr is not None:
+                self.visit(expr)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node: ast.ClassDef):
+        self.bind(node.name)
+
+        for expr in (*node.decorator_list, *node.bases, *node.keywords):
+            self.visit(expr)
+
+    def visit_Lambda(self, node: ast.Lambda):
+        for expr in (*node.args.defaults, *node.args.kw_defaults):
+            if expr is not None:
+                self.visit(expr)
+
+    def visit_ListComp(self, node: ast.expr):
+        self.comprehension += 1
+        self.generic_visit(node)
+        self.comprehension -= 1
+
+    visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_Import(self, node: ast.Import | ast.ImportFrom):
+        for alias in node.names:
+            if alias.name != "*":
+                self.bind(alias.asname or alias.name.partition(".")[0])
+
+    visit_ImportFrom = visit_Import
+
+    def visit_ExceptHandler(self, node: ast.ExceptHandler):
+        self.bind(node.name)
+        self.generic_visit(node)
+
+    def visit_MatchAs(self, node: ast.MatchAs):
+        self.bind(node.name)
+        self.generic_visit(node)
+
+    def visit_MatchStar(self, node: ast.MatchStar):
+        self.bind(node.name)
+
+    def visit_MatchMapping(self, node: ast.MatchMapping):
+        self.bind(node.rest)
+        self.generic_visit(node)
+
+
+# Wrap statements in a coroutine. Every name the snippet binds is declared global, so
+# it lives in (and is read back from) the session scope the code is exec'd in
+@lru_cache(maxsize=256)
+def wrap_coro(code: str) -> str:
+    body = "\n".join(f"  {line}" for line in code.split("\n"))
+    visitor = _BoundNames()
+
+    # Compiling the wrapped source reports syntax errors against the user's code
+    with suppress(SyntaxError):
+        visitor.visit(ie.parse(code, mode="exec"))
+
+    if visitor.names:
+        body = f"  global {', '.join(visitor.names)}\n{body}"
+
+    return f"async def __coro():\n{body}"
+
+
+class ReplSession:
+    def __init__(self, base: dict[str, Any]):
+        self.scope: dict[str, Any] = dict(base)
+        self.created = self.last_used = time.monotonic()
+        self.runs = 0
+
+    def update(self, **kwargs: Any) -> dict[str, Any]:
+        self.scope.update(kwargs)
+        self.last_used = time.monotonic()
+        self.runs += 1
+
+        return self.scope
@@ -0,0 +1,183 @@
+# MIT License
+#
+# Copyright (c) 2016-2023 AnonymousDapper
+#
+
+# REST call accounting for the bot's HTTP client
+#
+# Every request is counted by route template and by the cog whose code made it.
+# Rate limiting isn't exposed by discord.py other than through its `discord.http`
+# log records, so those are watched (and swallowed below the usual level) too.
+
+from __future__ import annotations
+
+__all__ = ("RestTracker", "RouteStats")
+
+import logging
+import sys
+import time
+from collections import deque
+from contextvars import ContextVar
+from functools import wraps
+from typing import TYPE_CHECKING
+
+from .metrics import Histogram
+
+if TYPE_CHECKING:
+    from discord.http import HTTPClient, Route
+
+# Per-minute windows kept for `top`
+REST_WINDOW_MINUTES = 60
+
+# How far up the stack to look for the calling cog
+CALLER_SEARCH_DEPTH = 64
+
+# The (per-minute, lifetime) stats of the request running in this task
+_current: ContextVar[tuple[RouteStats, ...]] = ContextVar("rest_route", default=())
+
+
+class RouteStats:
+    __slots__ = ("calls", "errors", "ratelimited", "exhausted", "retry_wait", "latency")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.ratelimited = 0
+        self.exhausted = 0
+        self.retry_wait = 0.0
+        self.latency = Histogram()
+
+    def merge(self, other: RouteStats):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.ratelimited += other.ratelimited
+        self.exhausted += other.exhausted
+        self.retry_wait += other.retry_wait
+        self.latency.merge(other.latency)
+
+
+# Name the cog module that started a request, e.g. "board" for cogs.board
+def _calling_cog() -> str:
+    frame = sys._getframe(2)
+
+    for _ in range(CALLER_SEARCH_DEPTH):
+        if frame is None:
+            break
+
+        name = frame.f_globals.get("__name__", "")
+        if name.startswith("cogs.") and not name.startswith("cogs.utils"):
+            return name[5:]
+
+        if name in ("__main__", "snake"):
+            return "snake"
+
+        frame = frame.f_back
+
+    return "discord"
+
+
+class RestTracker(logging.Filter):
+    def __init__(
+        self,
+        *,
+        window_minutes: int = REST_WINDOW_MINUTES,
+        passthrough_level: int = logging.INFO,
+    ):
+        super().__init__()
+        self.passthrough_level = passthrough_level
+
+        # (route, cog) -> stats, lifetime and per minute
+        self.totals: dict[tuple[str, str], RouteStats] = {}
+        self.windows: deque[tuple[int, dict[tuple[str, str], RouteStats]]] = deque(
+            maxlen=window_minutes
+        )
+        self.global_ratelimits = 0
+
+    def _stats(self, key: tuple[str, str]) -> tuple[RouteStats, RouteStats]:
+        minute = int(time.time() // 60)
+
+        if not self.windows or self.windows[-1][0] != minute:
+            self.windows.append((minute, {}))
+
+        window = self.windows[-1][1]
+
+        if (current := window.get(key)) is None:
+            current = window[key] = RouteStats()
+
+        if (total := self.totals.get(key)) is None:
+            total = self.totals[key] = RouteStats()
+
+        return current, total
+
+    def install(self, http: HTTPClient):
+        request = http.request
+
+        @wraps(request)
+        async def tracked_request(route: Route, **kwargs):
+            stats = self._stats((route.key, _calling_cog()))
+            token = _current.set(stats)
+            started = time.perf_counter()
+            failed = False
+
+            try:
+                return await request(route, **kwargs)
+
+            except Exception:
+                failed = True
+                raise
+
+            finally:
+                _current.reset(token)
+                elapsed = (time.perf_counter() - started) * 1000
+
+                for s in stats:
+                    s.calls += 1
+                    s.errors += failed
+                    s.latency.observe(elapsed)
+
+        http.request = tracked_request  # type: ignore
+
+        # Bucket exhaustion is only logged at debug level
+        http_log = logging.getLogger("discord.http")
+        http_log.setLevel(logging.DEBUG)
+        http_log.addFilter(self)
+
+    def _record_ratelimit(self, attr: str, value: float = 1):
+        for stats in _current.get():
+            setattr(stats, attr, getattr(stats, attr) + value)
+
+    # Runs on every discord.http record; rejects what the level would otherwise have hidden
+    def filter(self, record: logging.LogRecord) -> bool:
+        msg = record.msg
+
+        if isinstance(msg, str):
+            if msg.startswith("We are being rate limited."):
+                self._record_ratelimit("ratelimited")
+
+                if "Retrying in" in msg and record.args:
+                    self._record_ratelimit("retry_wait", record.args[-1])  # type: ignore
+
+            elif msg.startswith("A rate limit bucket"):
+                self._record_ratelimit("exhausted")
+
+            elif msg.startswith("Global rate limit has been hit"):
+                self.global_ratelimits += 1
+
+        return record.levelno >= self.passthrough_level
+
+    # Sum the last `minutes` of windows, busiest routes first
+    def top(self, minutes: int) -> list[tuple[tuple[str, str], RouteStats]]:
+        since = int(time.time() // 60) - minutes + 1
+        merged: dict[tuple[str, str], RouteStats] = {}
+
+        for minute, window in self.windows:
+            if minute < since:
+                continue
+
+            for key, stats in window.items():
+                if (entry := merged.get(key)) is None:
+                    entry = merged[key] = RouteStats()
+
+                entry.merge(stats)
+
+        return sorted(merged.items(), key=lambda i: -i[1].calls)
@@ -20,26 +20,206 @@ __all__ = (
     "PostMessage",
     "RawAutorole",
     "Autorole",
+    "RawLatexRender",
+    "QueryProfile",
 )
 
-from typing import TYPE_CHECKING, Optional, cast
-
+import asyncio
+import ctypes
+import gzip
+import inspect
+import shutil
+import sqlite3
+import time
+from functools import wraps
+from pathlib import Path
+from typing import Any, AsyncIterable, Iterable, Optional, Sequence, cast
+
+import _sqlite3
 import aiosqlite
 import msgspec
-from discord import (Client, Emoji, Guild, Message, PartialEmoji, Role,
-                     StageChannel, TextChannel, Thread, User)
-
-if TYPE_CHECKING:
-    from pathlib import Path
+from discord import (
+    Client,
+    Emoji,
+    Guild,
+    Member,
+    Message,
+    PartialEmoji,
+    Role,
+    StageChannel,
+    TextChannel,
+    Thread,
+    User,
+)
 
 from .logger import get_logger
+from .metrics import Histogram
 
 log = get_logger()
 
+# Our fixed query set is ~25 statements, leaving room for ad-hoc owner queries
+STATEMENT_CACHE_SIZE = 64
+
+# Rows per transaction for the streaming bulk methods and guild purges
+BULK_CHUNK_SIZE = 500
+
+# Pages freed per incremental_vacuum step
+COMPACT_STEP_PAGES = 256
+
+# Pages copied per online backup step, and the pause between steps (seconds)
+BACKUP_STEP_PAGES = 128
+BACKUP_STEP_SLEEP = 0.01
+
+# Whole-database jobs are slow by nature, and get their own slow-call threshold
+MAINTENANCE_METHODS = frozenset(("purge_guild", "compact", "backup"))
+
+# Longest argument repr kept in slow-query warnings
+SLOW_ARG_REPR = 80
+
+# Histogram bucket counts are stored as msgpack arrays
+_counts_encoder = msgspec.msgpack.Encoder()
+_counts_decoder = msgspec.msgpack.Decoder(list[int])
+
+# Imports may overlap with what's already tracked, so keep the newer react count
+BULK_ADD_BOARD_MESSAGES = """
+INSERT INTO board_messages (message_id, channel_id, guild_id, author_id, reacts, emote)
+VALUES(?, ?, ?, ?, ?, ?)
+ON CONFLICT(message_id) DO UPDATE SET reacts = excluded.reacts;
+"""
+
+BULK_REMOVE_BOARD_MESSAGES = """
+DELETE FROM board_messages
+WHERE message_id = ?;
+"""
+
+BULK_UPDATE_REACTS = """
+UPDATE board_messages
+SET reacts = ?2
+WHERE message_id = ?1;
+"""
+
 Emote = Emoji | PartialEmoji | str
 Channel = TextChannel | StageChannel | Thread
 
 
+# Rows fetched per batch while profiling (they're counted, then dropped)
+PROFILE_FETCH_SIZE = 1000
+
+# sqlite3_db_status() / sqlite3_stmt_status() ops, from sqlite3.h
+_DBSTATUS_CACHE_HIT = 7
+_DBSTATUS_CACHE_MISS = 8
+_STMTSTATUS_FULLSCAN_STEP = 1
+_STMTSTATUS_SORT = 2
+_STMTSTATUS_AUTOINDEX = 3
+_STMTSTATUS_VM_STEP = 4
+
+
+class QueryProfile(msgspec.Struct):
+    plan: list[tuple]
+    elapsed: float
+    first_row: Optional[float]
+    rows: int
+    changes: int
+    vm_steps: int
+    exact_steps: bool = False
+
+    # None when the sqlite library's status counters can't be reached
+    fullscan_steps: Optional[int] = None
+    sorts: Optional[int] = None
+    autoindex_rows: Optional[int] = None
+    cache_hits: Optional[int] = None
+    cache_misses: Optional[int] = None
+
+
+# The sqlite3 module doesn't wrap the status interfaces, so they're called from the
+# library it links against
+def _load_sqlite_api() -> Optional[ctypes.CDLL]:
+    try:
+        lib = ctypes.CDLL(_sqlite3.__file__)
+
+        lib.sqlite3_db_filename.argtypes = (ctypes.c_void_p, ctypes.c_char_p)
+        lib.sqlite3_db_filename.restype = ctypes.c_char_p
+        lib.sqlite3_db_status.argtypes = (
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int),
+            ctypes.POINTER(ctypes.c_int),
+            ctypes.c_int,
+        )
+        lib.sqlite3_db_status.restype = ctypes.c_int
+        lib.sqlite3_next_stmt.argtypes = (ctypes.c_void_p, ctypes.c_void_p)
+        lib.sqlite3_next_stmt.restype = ctypes.c_void_p
+        lib.sqlite3_sql.argtypes = (ctypes.c_void_p,)
+        lib.sqlite3_sql.restype = ctypes.c_char_p
+        lib.sqlite3_stmt_status.argtypes = (ctypes.c_void_p, ctypes.c_int, ctypes.c_int)
+        lib.sqlite3_stmt_status.restype = ctypes.c_int
+
+    except (AttributeError, OSError):
+        return None
+
+    return lib
+
+
+_sqlite_api = _load_sqlite_api()
+
+
+# CPython keeps the sqlite3* right after the object header; the filename check guards
+# against any other layout
+def _db_handle(conn: sqlite3.Connection, db_file: str | Path) -> Optional[int]:
+    if _sqlite_api is None:
+        return None
+
+    db = ctypes.c_void_p.from_address(id(conn) + object.__basicsize__).value
+    if not db:
+        return None
+
+    try:
+        filename = _sqlite_api.sqlite3_db_filename(db, b"main")
+
+    except OSError:
+        return None
+
+    if not filename or Path(filename.decode()).resolve() != Path(db_file).resolve():
+        return None
+
+    return db
+
+
+def _db_status(
+    db: Optional[int], *ops: int, reset: bool = False
+) -> Optional[list[int]]:
+    if _sqlite_api is None or db is None:
+        return None
+
+    values = []
+    for op in ops:
+        current, highwater = ctypes.c_int(), ctypes.c_int()
+        if _sqlite_api.sqlite3_db_status(
+            db, op, ctypes.byref(current), ctypes.byref(highwater), int(reset)
+        ):
+            return None
+
+        values.append(current.value)
+
+    return values
+
+
+def _stmt_status(db: Optional[int], sql: str, *ops: int) -> Optional[list[int]]:
+    if _sqlite_api is None or db is None:
+        return None
+
+    text = sql.encode()
+    stmt = _sqlite_api.sqlite3_next_stmt(db, None)
+
+    while stmt:
+        if _sqlite_api.sqlite3_sql(stmt) == text:
+            return [_sqlite_api.sqlite3_stmt_status(stmt, op, 0) for op in ops]
+
+        stmt = _sqlite_api.sqlite3_next_stmt(db, stmt)
+
+    return None
+
+
 class ResolveError(Exception):
     def __init__(self, cls, item, *args):
         super().__init__(cls, item, *args)
@@ -50,6 +230,8 @@ class ResolveError(Exception):
         return f"Resolving {self.cls} failed (bad item: {self.item})"
 
 
+# Raw* structs are decoded straight from plain tuple rows. They never form reference
+# cycles, so they skip GC tracking to keep per-row allocation cheap
 class DBObject(msgspec.Struct):
     _db: SQL
 
@@ -57,7 +239,7 @@ class DBObject(msgspec.Struct):
 # helper classes to simplify resolving IDs
 
 
-class RawMessage(msgspec.Struct):
+class RawMessage(msgspec.Struct, gc=False):
     message_id: int
     channel_id: int
     guild_id: int
@@ -79,7 +261,7 @@ class RawMessage(msgspec.Struct):
             raise ResolveError("Message", self.message_id)
 
 
-class RawEmoteBoard(DBObject):
+class RawEmoteBoard(DBObject, gc=False):
     id: int
     guild_id: int
     channel_id: int
@@ -117,7 +299,7 @@ class EmoteBoard(DBObject):
     emote: Emote
 
 
-class RawBoardMessage(DBObject):
+class RawBoardMessage(DBObject, gc=False):
     message_id: int
     channel_id: int
     guild_id: int
@@ -191,7 +373,7 @@ class BoardMessage(DBObject):
         await self._db.remove_board_message(self.message.id)
 
 
-class RawBoardUser(DBObject):
+class RawBoardUser(DBObject, gc=False):
     id: int
     total_reacts: int
     message_count: int
@@ -202,9 +384,16 @@ class RawBoardUser(DBObject):
     total_users: int
     _board_id: int
 
-    async def resolve(self, client: Client) -> BoardUser:
-        if not (user := client.get_user(self.id)):
-            raise ResolveError("BoardUser.user", self.id)
+    async def resolve(
+        self, client: Client, user: Optional[User | Member] = None
+    ) -> BoardUser:
+        # Without the members intent discord.py caches no users, so this often hits REST
+        if user is None and not (user := client.get_user(self.id)):
+            try:
+                user = await client.fetch_user(self.id)
+
+            except Exception as e:
+                raise ResolveError("BoardUser.user", self.id) from e
 
         best = None
         worst = None
@@ -240,7 +429,7 @@ class RawBoardUser(DBObject):
 
 
 class BoardUser(msgspec.Struct):
-    user: User
+    user: User | Member
     total: int
     messages: int
     rank: int
@@ -252,7 +441,7 @@ class BoardUser(msgspec.Struct):
     users_count: int
 
 
-class RawPostMessage(DBObject):
+class RawPostMessage(DBObject, gc=False):
     message_id: int
     post_id: int
 
@@ -278,7 +467,7 @@ class PostMessage(DBObject):
             self.original = new
 
 
-class RawAutorole(DBObject):
+class RawAutorole(DBObject, gc=False):
     role_id: int
     guild_id: int
     channel_id: int
@@ -313,25 +502,261 @@ class Autorole(DBObject):
     emote: Emote
 
 
+class RawLatexRender(DBObject, gc=False):
+    message_id: int
+    channel_id: int
+    author_id: int
+    source_hash: str
+    cache_key: str
+    staging_path: str
+    source: str
+
+
+# Bulk methods take thousands of rows, so warnings only show their size
+def _summarize_arg(arg: Any) -> str:
+    if isinstance(arg, (list, tuple, set, dict)):
+        return f"<{type(arg).__name__} of {len(arg)}>"
+
+    if not isinstance(arg, (str, bytes)) and hasattr(arg, "__iter__"):
+        return f"<{type(arg).__name__}>"
+
+    text = repr(arg)
+    if len(text) > SLOW_ARG_REPR:
+        return f"{text[:SLOW_ARG_REPR]}..."
+
+    return text
+
+
+# Record call count and latency for a query method, logging it if it's slow
+def timed(func):
+    name = func.__name__
+
+    if inspect.isasyncgenfunction(func):
+        # Only time spent inside the generator counts, not the caller's work between rows
+        @wraps(func)
+        async def gen_wrapper(self: SQL, *args, **kwargs):
+            gen = func(self, *args, **kwargs)
+            elapsed = 0.0
+            failed = False
+
+            try:
+                while True:
+                    started = time.perf_counter()
+
+                    try:
+                        item = await gen.__anext__()
+
+                    except StopAsyncIteration:
+                        break
+
+                    except BaseException:
+                        failed = True
+                        raise
+
+                    finally:
+                        elapsed += time.perf_counter() - started
+
+                    yield item
+
+            finally:
+                await gen.aclose()
+                self._record(name, elapsed, failed, args)
+
+        return gen_wrapper
+
+    @wraps(func)
+    async def wrapper(self: SQL, *args, **kwargs):
+        started = time.perf_counter()
+        failed = False
+
+        try:
+            return await func(self, *args, **kwargs)
+
+        except BaseException:
+            failed = True
+            raise
+
+        finally:
+            self._record(name, time.perf_counter() - started, failed, args)
+
+    return wrapper
+
+
 class SQL:
-    def __init__(self, db_file: str | Path):
+    def __init__(
+        self,
+        db_file: str | Path,
+        schema_file: Optional[str | Path] = None,
+        slow_query_ms: float = 100.0,
+        slow_maintenance_ms: float = 60000.0,
+        busy_timeout_ms: int = 5000,
+        wal: bool = False,
+    ):
         self.db_file = db_file
+        self.schema_file = schema_file
+        self.slow_query_ms = slow_query_ms
+        self.slow_maintenance_ms = slow_maintenance_ms
+        self.busy_timeout_ms = busy_timeout_ms
+        self.wal = wal
         self.conn: aiosqlite.Connection
         self._ready = False
 
+        self.latency: dict[str, Histogram] = {}
+        self.errors: dict[str, int] = {}
+
+    def _record(self, name: str, elapsed: float, failed: bool, args: tuple):
+        ms = elapsed * 1000
+
+        if (hist := self.latency.get(name)) is None:
+            hist = self.latency[name] = Histogram()
+
+        hist.observe(ms)
+
+        if failed:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+        if name in MAINTENANCE_METHODS:
+            threshold = self.slow_maintenance_ms
+
+        else:
+            threshold = self.slow_query_ms
+
+        if ms >= threshold:
+            log.warning(
+                f"Slow query {name}({', '.join(map(_summarize_arg, args))}) took {ms:.1f}ms"
+            )
+
+    def reset_stats(self):
+        self.latency.clear()
+        self.errors.clear()
+
+    # Machine-readable snapshot of per-method query stats (latencies in ms)
+    def dump_stats(self) -> dict[str, Any]:
+        return {
+            name: dict(
+                hist.to_dict(),
+                errors=self.errors.get(name, 0),
+                p50=hist.quantile(0.5),
+                p95=hist.quantile(0.95),
+                p99=hist.quantile(0.99),
+            )
+            for name, hist in self.latency.items()
+        }
+
     async def _setup(self):
         if not self._ready:
-            self.conn = await aiosqlite.connect(self.db_file)
-            self.conn.row_factory = aiosqlite.Row
+            self.conn = await aiosqlite.connect(
+                self.db_file, cached_statements=STATEMENT_CACHE_SIZE
+            )
             await self.conn.execute("PRAGMA foreign_keys = ON;")
+            await self.conn.execute(
+                f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)};"
+            )
+
+            # Other processes (clusters) may share the file; WAL lets them read while one writes
+            if self.wal:
+                await self.conn.execute("PRAGMA journal_mode = WAL;")
+
+            # Schema is idempotent, so this only creates tables added since the db was made
+            if self.schema_file:
+                with open(self.schema_file, "r") as f:
+                    await self.conn.executescript(f.read())
+
             self._ready = True
 
     async def close(self):
         if self._ready:
             await self.conn.close()
 
+    # Run an ad-hoc query on a private connection and measure it. The shared connection
+    # is committed first so the query sees (and doesn't wait on) its writes
+    async def profile(self, sql: str, progress_step: int) -> QueryProfile:
+        await self.conn.commit()
+
+        def _run() -> QueryProfile:
+            conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout_ms / 1000)
+
+            try:
+                conn.execute("PRAGMA foreign_keys = ON;")
+
+                plan = [tuple(row) for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+
+                # The progress handler fires every N virtual machine instructions
+                steps = 0
+
+                def _count_steps():
+                    nonlocal steps
+                    steps += 1
+                    return 0
+
+                conn.set_progress_handler(_count_steps, progress_step)
+
+                db = _db_handle(conn, self.db_file)
+                cache = _db_status(
+                    db, _DBSTATUS_CACHE_HIT, _DBSTATUS_CACHE_MISS, reset=True
+                )
+
+                rows = 0
+                started = time.perf_counter()
+                first_row = None
+
+                cur = conn.execute(sql)
+
+                try:
+                    while batch := cur.fetchmany(PROFILE_FETCH_SIZE):
+                        first_row = first_row or time.perf_counter()
+                        rows += len(batch)
+
+                    elapsed = time.perf_counter() - started
+
+                    # Read the statement's counters while the cursor still holds it
+                    counters = _stmt_status(
+                        db,
+                        sql,
+                        _STMTSTATUS_FULLSCAN_STEP,
+                        _STMTSTATUS_SORT,
+                        _STMTSTATUS_AUTOINDEX,
+                        _STMTSTATUS_VM_STEP,
+                    )
+                    cache = _db_status(db, _DBSTATUS_CACHE_HIT, _DBSTATUS_CACHE_MISS)
+
+                finally:
+                    cur.close()
+
+                changes = conn.total_changes
+                conn.commit()
+
+            finally:
+                conn.close()
+
+            profile = QueryProfile(
+                plan=plan,
+                elapsed=elapsed,
+                first_row=first_row and first_row - started,
+                rows=rows,
+                changes=changes,
+                vm_steps=steps * progress_step,
+            )
+
+            if counters:
+                (
+                    profile.fullscan_steps,
+                    profile.sorts,
+                    profile.autoindex_rows,
+                    profile.vm_steps,
+                ) = counters
+                profile.exact_steps = True
+
+            if cache:
+                profile.cache_hits, profile.cache_misses = cache
+
+            return profile
+
+        return await asyncio.to_thread(_run)
+
     # => boards
 
+    @timed
     async def get_board(self, guild_id: int, emote: Emote) -> Optional[RawEmoteBoard]:
         async with self.conn.execute(
             """
@@ -344,6 +769,7 @@ class SQL:
             if data := await cur.fetchone():
                 return RawEmoteBoard(self, *data)
 
+    @timed
     async def get_board_by_id(self, board_id: int) -> Optional[RawEmoteBoard]:
         async with self.conn.execute(
             """
@@ -356,6 +782,7 @@ class SQL:
             if data := await cur.fetchone():
                 return RawEmoteBoard(self, *data)
 
+    @timed
     async def list_boards(self, guild_id: int):
         async with self.conn.execute(
             """
@@ -368,6 +795,7 @@ class SQL:
             async for row in cur:
                 yield RawEmoteBoard(self, *row)
 
+    @timed
     async def add_board(
         self, guild_id: int, channel_id: int, threshold: int, name: str, emote: Emote
     ) -> RawEmoteBoard:
@@ -379,14 +807,20 @@ class SQL:
             """,
             (guild_id, channel_id, threshold, name, str(emote)),
         ) as cur:
-            if data := await cur.fetchone():
-                return RawEmoteBoard(self, *data)
+            data = await cur.fetchone()
+
+        # Writes commit immediately: an open transaction would lock out other clusters
+        await self.conn.commit()
+
+        if data:
+            return RawEmoteBoard(self, *data)
 
         log.critical(f"[Add board failed] {guild_id}#{channel_id} {name}")
         raise RuntimeError(f"Adding board for {channel_id} failed")
 
     # => board messages
 
+    @timed
     async def get_board_message(self, message_id: int) -> Optional[RawBoardMessage]:
         async with self.conn.execute(
             """
@@ -399,6 +833,7 @@ class SQL:
             if data := await cur.fetchone():
                 return RawBoardMessage(self, *data)
 
+    @timed
     async def get_board_message_by_post(
         self, post_message_id: int
     ) -> Optional[RawBoardMessage]:
@@ -414,6 +849,7 @@ class SQL:
             if data := await cur.fetchone():
                 return RawBoardMessage(self, *data)
 
+    @timed
     async def get_board_message_by_reacts(
         self, author_id: int, num_reacts: int, board_id: int
     ) -> Optional[RawMessage]:
@@ -428,6 +864,7 @@ class SQL:
             if data := await cur.fetchone():
                 return RawMessage(*data)
 
+    @timed
     async def get_newest_message_by_author(
         self, author_id: int
     ) -> Optional[RawMessage]:
@@ -443,6 +880,7 @@ class SQL:
             if data := await cur.fetchone():
                 return RawMessage(*data)
 
+    @timed
     async def add_board_message(
         self,
         message_id: int,
@@ -460,12 +898,17 @@ class SQL:
             """,
             (message_id, channel_id, guild_id, author_id, reacts, emote_fk),
         ) as cur:
-            if data := await cur.fetchone():
-                return RawBoardMessage(self, *data)
+            data = await cur.fetchone()
+
+        await self.conn.commit()
+
+        if data:
+            return RawBoardMessage(self, *data)
 
         log.critical(f"[Add board message failed] {guild_id}#{channel_id} {message_id}")
         raise RuntimeError(f"Adding board message for {message_id} failed")
 
+    @timed
     async def update_board_message(
         self, message_id: int, reacts: int
     ) -> RawBoardMessage:
@@ -478,12 +921,17 @@ class SQL:
             """,
             (reacts, message_id),
         ) as cur:
-            if data := await cur.fetchone():
-                return RawBoardMessage(self, *data)
+            data = await cur.fetchone()
+
+        await self.conn.commit()
+
+        if data:
+            return RawBoardMessage(self, *data)
 
         log.critical(f"[Update board message failed] {message_id}")
         raise RuntimeError(f"Updating board message for {message_id} failed")
 
+    @timed
     async def remove_board_message(self, message_id: int):
         await self.conn.execute(
             """
@@ -494,6 +942,7 @@ class SQL:
         )
         await self.conn.commit()
 
+    @timed
     async def get_boardleaders(self, board_id: int):
         async with self.conn.execute(
             """
@@ -515,6 +964,7 @@ class SQL:
             async for row in cur:
                 yield RawBoardUser(self, *row)
 
+    @timed
     async def get_boarduser_stats(
         self, board_id: int, user_id: int
     ) -> Optional[RawBoardUser]:
@@ -553,6 +1003,7 @@ class SQL:
 
     # => board posts
 
+    @timed
     async def get_board_post(self, post_id: int) -> Optional[RawPostMessage]:
         async with self.conn.execute(
             """
@@ -565,6 +1016,7 @@ class SQL:
             if data := await cur.fetchone():
                 return RawPostMessage(self, *data)
 
+    @timed
     async def get_board_post_for_message(
         self, message_id: int
     ) -> Optional[RawPostMessage]:
@@ -579,6 +1031,7 @@ class SQL:
             if data := await cur.fetchone():
                 return RawPostMessage(self, *data)
 
+    @timed
     async def get_board_post_data(self, post_id: int) -> Optional[RawMessage]:
         async with self.conn.execute(
             """
@@ -593,6 +1046,7 @@ class SQL:
             if data := await cur.fetchone():
                 return RawMessage(*data)
 
+    @timed
     async def add_board_post(self, original_id: int, post_id: int) -> RawPostMessage:
         async with self.conn.execute(
             """
@@ -602,14 +1056,19 @@ class SQL:
             """,
             (original_id, post_id),
         ) as cur:
-            if data := await cur.fetchone():
-                return RawPostMessage(self, *data)
+            data = await cur.fetchone()
+
+        await self.conn.commit()
+
+        if data:
+            return RawPostMessage(self, *data)
 
         log.critical(f"[Add post failed] {original_id} -> {post_id}")
         raise RuntimeError(f"Adding post {post_id} for {original_id} failed")
 
     # => autoroles
 
+    @timed
     async def get_autorole(
         self, guild_id: int, message_id: int, emote: Emote
     ) -> Optional[RawAutorole]:
@@ -624,6 +1083,7 @@ class SQL:
             if data := await cur.fetchone():
                 return RawAutorole(self, *data)
 
+    @timed
     async def list_autoroles_for_guild(self, guild_id: int):
         async with self.conn.execute(
             """
@@ -636,6 +1096,7 @@ class SQL:
             async for row in cur:
                 yield RawAutorole(self, *row)
 
+    @timed
     async def add_autorole(
         self,
         role_id: int,
@@ -652,10 +1113,386 @@ class SQL:
             """,
             (role_id, guild_id, channel_id, message_id, str(emote)),
         ) as cur:
-            if data := await cur.fetchone():
-                return RawAutorole(self, *data)
+            data = await cur.fetchone()
+
+        await self.conn.commit()
+
+        if data:
+            return RawAutorole(self, *data)
 
         log.critical(
             f"[Add autorole failed] {guild_id}#{channel_id} {message_id} [{role_id}]"
         )
         raise RuntimeError(f"Adding autorole for {message_id} [{role_id}] failed")
+
+    # => latex renders
+
+    @timed
+    async def get_latex_render(self, message_id: int) -> Optional[RawLatexRender]:
+        async with self.conn.execute(
+            """
+            SELECT message_id, channel_id, author_id, source_hash, cache_key, staging_path, source
+            FROM latex_renders
+            WHERE message_id = ?;
+            """,
+            (message_id,),
+        ) as cur:
+            if data := await cur.fetchone():
+                return RawLatexRender(self, *data)
+
+    @timed
+    async def get_latex_render_by_key(self, cache_key: str) -> Optional[RawLatexRender]:
+        async with self.conn.execute(
+            """
+            SELECT message_id, channel_id, author_id, source_hash, cache_key, staging_path, source
+            FROM latex_renders
+            WHERE cache_key = ?
+            ORDER BY message_id DESC;
+            """,
+            (cache_key,),
+        ) as cur:
+            if data := await cur.fetchone():
+                return RawLatexRender(self, *data)
+
+    @timed
+    async def get_latex_staging_paths(self) -> list[str]:
+        async with self.conn.execute(
+            """
+            SELECT DISTINCT staging_path FROM latex_renders;
+            """
+        ) as cur:
+            return [row[0] for row in await cur.fetchall()]
+
+    @timed
+    async def remove_latex_renders(self, staging_paths: Iterable[str]) -> int:
+        changes = self.conn.total_changes
+
+        await self.conn.executemany(
+            """
+            DELETE FROM latex_renders
+            WHERE staging_path = ?;
+            """,
+            ((path,) for path in staging_paths),
+        )
+        await self.conn.commit()
+
+        return self.conn.total_changes - changes
+
+    @timed
+    async def add_latex_render(
+        self,
+        message_id: int,
+        channel_id: int,
+        author_id: int,
+        source_hash: str,
+        cache_key: str,
+        staging_path: str,
+        source: str,
+    ) -> RawLatexRender:
+        async with self.conn.execute(
+            """
+            INSERT INTO latex_renders (message_id, channel_id, author_id, source_hash, cache_key, staging_path, source)
+            VALUES(?, ?, ?, ?, ?, ?, ?)
+            RETURNING message_id, channel_id, author_id, source_hash, cache_key, staging_path, source;
+            """,
+            (
+                message_id,
+                channel_id,
+                author_id,
+                source_hash,
+                cache_key,
+                staging_path,
+                source,
+            ),
+        ) as cur:
+            if data := await cur.fetchone():
+                await self.conn.commit()
+                return RawLatexRender(self, *data)
+
+        log.critical(f"[Add latex render failed] {channel_id} {message_id}")
+        raise RuntimeError(f"Adding latex render for {message_id} failed")
+
+    # => command stats
+
+    # Fold a window of per-command (latency histogram, error count) into its rollup rows
+    @timed
+    async def add_command_stats(
+        self, bucket: int, stats: dict[str, tuple[Histogram, int]]
+    ):
+        rows = []
+
+        # Take the write lock up front, other clusters may be merging into the same rows
+        await self.conn.commit()
+        await self.conn.execute("BEGIN IMMEDIATE;")
+
+        try:
+            for command, (hist, errors) in stats.items():
+                async with self.conn.execute(
+                    """
+                    SELECT errors, total_ms, max_ms, counts FROM command_stats
+                    WHERE bucket = ? AND command = ?;
+                    """,
+                    (bucket, command),
+                ) as cur:
+                    if data := await cur.fetchone():
+                        merged = Histogram.from_counts(
+                            _counts_decoder.decode(data[3]), data[1], data[2]
+                        )
+                        merged.merge(hist)
+
+                        hist, errors = merged, errors + data[0]
+
+                rows.append(
+                    (
+                        bucket,
+                        command,
+                        errors,
+                        hist.total,
+                        hist.max,
+                        _counts_encoder.encode(hist.counts),
+                    )
+                )
+
+            await self.conn.executemany(
+                """
+                INSERT OR REPLACE INTO command_stats (bucket, command, errors, total_ms, max_ms, counts)
+                VALUES(?, ?, ?, ?, ?, ?);
+                """,
+                rows,
+            )
+
+        except BaseException:
+            await self.conn.rollback()
+            raise
+
+        await self.conn.commit()
+
+    @timed
+    async def get_command_stats(self, since: int) -> dict[str, tuple[Histogram, int]]:
+        stats: dict[str, tuple[Histogram, int]] = {}
+
+        async with self.conn.execute(
+            """
+            SELECT command, errors, total_ms, max_ms, counts FROM command_stats
+            WHERE bucket >= ?;
+            """,
+            (since,),
+        ) as cur:
+            async for command, errors, total, max_ms, counts in cur:
+                hist = Histogram.from_counts(
+                    _counts_decoder.decode(counts), total, max_ms
+                )
+
+                if (entry := stats.get(command)) is None:
+                    stats[command] = (hist, errors)
+
+                else:
+                    entry[0].merge(hist)
+                    stats[command] = (entry[0], entry[1] + errors)
+
+        return stats
+
+    @timed
+    async def prune_command_stats(self, before: int) -> int:
+        async with self.conn.execute(
+            "DELETE FROM command_stats WHERE bucket < ?;", (before,)
+        ) as cur:
+            count = cur.rowcount
+
+        await self.conn.commit()
+        return count
+
+    # => bulk operations
+
+    # Run one statement over many rows in a single transaction
+    async def _executemany(self, query: str, rows: Iterable[Sequence[Any]]) -> int:
+        before = self.conn.total_changes
+
+        try:
+            await self.conn.executemany(query, rows)
+            await self.conn.commit()
+
+        except BaseException:
+            await self.conn.rollback()
+            raise
+
+        return self.conn.total_changes - before
+
+    # Same as above, committing every `chunk_size` rows so writers never wait long
+    async def _executemany_stream(
+        self, query: str, rows: AsyncIterable[Sequence[Any]], chunk_size: int
+    ) -> int:
+        total = 0
+        chunk = []
+
+        async for row in rows:
+            chunk.append(row)
+
+            if len(chunk) >= chunk_size:
+                total += await self._executemany(query, chunk)
+                chunk = []
+
+        if chunk:
+            total += await self._executemany(query, chunk)
+
+        return total
+
+    # rows are (message_id, channel_id, guild_id, author_id, reacts, emote_fk)
+    @timed
+    async def add_board_messages_many(
+        self, rows: Iterable[tuple[int, int, int, int, int, int]]
+    ) -> int:
+        return await self._executemany(BULK_ADD_BOARD_MESSAGES, rows)
+
+    @timed
+    async def add_board_messages_stream(
+        self,
+        rows: AsyncIterable[tuple[int, int, int, int, int, int]],
+        chunk_size: int = BULK_CHUNK_SIZE,
+    ) -> int:
+        return await self._executemany_stream(BULK_ADD_BOARD_MESSAGES, rows, chunk_size)
+
+    # rows are (message_id,)
+    @timed
+    async def remove_board_messages_many(self, rows: Iterable[tuple[int]]) -> int:
+        return await self._executemany(BULK_REMOVE_BOARD_MESSAGES, rows)
+
+    @timed
+    async def remove_board_messages_stream(
+        self, rows: AsyncIterable[tuple[int]], chunk_size: int = BULK_CHUNK_SIZE
+    ) -> int:
+        return await self._executemany_stream(
+            BULK_REMOVE_BOARD_MESSAGES, rows, chunk_size
+        )
+
+    # rows are (message_id, reacts)
+    @timed
+    async def update_reacts_many(self, rows: Iterable[tuple[int, int]]) -> int:
+        return await self._executemany(BULK_UPDATE_REACTS, rows)
+
+    @timed
+    async def update_reacts_stream(
+        self, rows: AsyncIterable[tuple[int, int]], chunk_size: int = BULK_CHUNK_SIZE
+    ) -> int:
+        return await self._executemany_stream(BULK_UPDATE_REACTS, rows, chunk_size)
+
+    # => maintenance
+
+    async def _pragma(self, name: str) -> Any:
+        async with self.conn.execute(f"PRAGMA {name};") as cur:
+            if data := await cur.fetchone():
+                return data[0]
+
+    # Delete everything belonging to a guild in small batches, so writes never queue up
+    # behind one long delete. Board posts go with their messages (ON DELETE CASCADE)
+    @timed
+    async def purge_guild(
+        self, guild_id: int, batch_size: int = BULK_CHUNK_SIZE
+    ) -> dict[str, int]:
+        removed = {}
+
+        for table in ("board_messages", "autoroles", "boards"):
+            removed[table] = 0
+
+            while True:
+                async with self.conn.execute(
+                    f"""
+                    DELETE FROM {table}
+                    WHERE rowid IN (SELECT rowid FROM {table} WHERE guild_id = ? LIMIT ?);
+                    """,
+                    (guild_id, batch_size),
+                ) as cur:
+                    count = cur.rowcount
+
+                await self.conn.commit()
+                removed[table] += count
+
+                if count < batch_size:
+                    break
+
+                await asyncio.sleep(0)
+
+        return removed
+
+    # Return free pages to the OS and refresh planner statistics
+    # Returns (page count before, page count after)
+    @timed
+    async def compact(self, step_pages: int = COMPACT_STEP_PAGES) -> tuple[int, int]:
+        await self.conn.commit()
+        before = await self._pragma("page_count")
+
+        # Switching to incremental mode needs one full VACUUM, later runs can go in steps
+        if await self._pragma("auto_vacuum") != 2:
+            await self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            await self.conn.execute("VACUUM;")
+
+        else:
+            while await self._pragma("freelist_count"):
+                # Each step of this pragma frees one page, so it has to be drained
+                async with self.conn.execute(
+                    f"PRAGMA incremental_vacuum({step_pages});"
+                ) as cur:
+                    await cur.fetchall()
+
+                await asyncio.sleep(0)
+
+        await self.conn.execute("ANALYZE;")
+        await self.conn.commit()
+
+        return before, await self._pragma("page_count")
+
+    # Copy the live database page by page from a separate connection, so the read lock
+    # is only held for one step at a time and queries on self.conn keep flowing.
+    # Writes landing mid-copy make SQLite restart the copy, which is cheap at our size.
+    # Returns the number of pages in the snapshot
+    @timed
+    async def backup(
+        self,
+        target: str | Path,
+        *,
+        compress: bool = True,
+        step_pages: int = BACKUP_STEP_PAGES,
+    ) -> int:
+        target = Path(target)
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        def _run() -> int:
+            snapshot = target.with_name(f"{target.name}.partial")
+            pages = 0
+
+            def _progress(status: int, remaining: int, total: int):
+                nonlocal pages
+                pages = total
+
+            source = sqlite3.connect(self.db_file)
+            dest = sqlite3.connect(snapshot)
+
+            try:
+                source.backup(
+                    dest, pages=step_pages, progress=_progress, sleep=BACKUP_STEP_SLEEP
+                )
+
+            finally:
+                dest.close()
+                source.close()
+
+            # Only complete archives ever appear under the target name
+            archive = target.with_name(f"{target.name}.tmp")
+
+            try:
+                if compress:
+                    with open(snapshot, "rb") as f, gzip.open(archive, "wb") as out:
+                        shutil.copyfileobj(f, out)
+
+                    archive.replace(target)
+
+                else:
+                    snapshot.replace(target)
+
+            finally:
+                snapshot.unlink(missing_ok=True)
+                archive.unlink(missing_ok=True)
+
+            return pages
+
+        return await asyncio.to_thread(_run)
@@ -7,8 +7,9 @@
 # Copyright (c) 2016-2023 AnonymousDapper
 #
 
-__all__ = ("LATEX_HEADER", "Program")
+__all__ = ("LATEX_HEADER", "Program", "read_page_size", "choose_density")
 
+import re
 import shutil
 from enum import Enum
 from pathlib import Path
@@ -31,6 +32,16 @@ TIMEOUT_PATH = shutil.which("timeout") or ""
 MKDIR_PATH = shutil.which("mkdir") or ""
 SH_PATH = shutil.which("sh") or ""
 RM_PATH = shutil.which("rm") or ""
+PDFINFO_PATH = shutil.which("pdfinfo") or ""
+
+# Rasterization density bounds (DPI), 700 being the old fixed value
+MAX_DENSITY = 700
+MIN_DENSITY = 96
+
+_MEDIABOX = re.compile(
+    rb"/MediaBox\s*\[\s*([\d.+-]+)\s+([\d.+-]+)\s+([\d.+-]+)\s+([\d.+-]+)\s*\]"
+)
+_PDFINFO_SIZE = re.compile(r"Page size:\s*([\d.]+) x ([\d.]+) pts")
 
 
 class Program(Enum):
@@ -40,3 +51,34 @@ class Program(Enum):
     MakeDir = Path(MKDIR_PATH).resolve()
     Sh = Path(SH_PATH).resolve()
     Rm = Path(RM_PATH).resolve()
+    PdfInfo = Path(PDFINFO_PATH).resolve()
+
+
+# Get page (width, height) in points from `pdfinfo` output, or the raw PDF as a fallback
+def read_page_size(
+    pdf_path: Path, pdfinfo_output: str = ""
+) -> tuple[float, float] | None:
+    if match := _PDFINFO_SIZE.search(pdfinfo_output):
+        return float(match[1]), float(match[2])
+
+    try:
+        data = pdf_path.read_bytes()
+
+    except OSError:
+        return None
+
+    if match := _MEDIABOX.search(data):
+        x0, y0, x1, y1 = map(float, match.groups())
+        return abs(x1 - x0), abs(y1 - y0)
+
+    return None
+
+
+# Pick a DPI so the rendered page comes out at roughly `target_width` pixels
+def choose_density(page_width: float | None, target_width: int) -> int:
+    if not page_width or page_width <= 0:
+        return MAX_DENSITY
+
+    density = round(target_width * 72 / page_width)
+
+    return max(MIN_DENSITY, min(MAX_DENSITY, density))
@@ -1,5 +1,7 @@
 #!/usr/bin/env sh
-cd tex/staging/$1/
+FAILED="$(pwd)/tex/failed.png"
+cd "$1"
+shift
 
 timeout 1m xelatex -no-shell-escape $1.tex > texout.log 2>&1
 
@@ -16,36 +18,6 @@ fi
 
 if [ ! -f $1.pdf ];
 then
-  cp ../../failed.png $1.png
+  cp "$FAILED" $1.png
   exit 1
-fi
-
-timeout 20 convert -density 700 -quality 75 -depth 8 -trim +repage $1.pdf -colorspace sRGB PNG32:$1.png;
-if [ $? -eq 124 ];
-then
- echo "Image processing timed out!";
- cp ../../failed.png $1.png
- exit 1
-fi
-
-timeout 20 convert $1.png -bordercolor transparent -border 50 -background 'transparent' -flatten PNG32:$1.png;
-
-if [ $? -eq 124 ]; then
-  echo "Recoloring timed out!";
-  cp ../../failed.png $1.png
-  exit 1
-fi
-
-width=`convert $1.png -format "%[fx:w]" info:`
-minwidth=1000
-extra=$((minwidth-width))
-
-if [ $extra -gt 0 ]; then
-  timeout 20 convert $1.png -gravity East +antialias -splice ${extra}x -alpha set -background transparent -alpha Background -channel alpha -fx "i>${width}-5?0:a" +channel PNG32:$1.png;
-
-  if [ $? -eq 124 ]; then
-    echo "Padding timed out!";
-    cp ../../failed.png $1.png
-    exit 1
-  fi
 fi
\ No newline at end of file
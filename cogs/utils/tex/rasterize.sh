@@ -0,0 +1,51 @@
+#!/usr/bin/env sh
+FAILED="$(pwd)/tex/failed.png"
+cd "$1"
+shift
+
+DENSITY=${2:-700}
+
+# pdftocairo (poppler) is much faster than ghostscript via convert
+if command -v pdftocairo > /dev/null 2>&1;
+then
+  timeout 20 pdftocairo -png -transp -singlefile -r $DENSITY $1.pdf $1;
+  RET=$?
+
+  if [ $RET -eq 0 ];
+  then
+    timeout 20 convert $1.png -trim +repage -depth 8 -colorspace sRGB PNG32:$1.png;
+    RET=$?
+  fi
+else
+  timeout 20 convert -density $DENSITY -quality 75 -depth 8 -trim +repage $1.pdf -colorspace sRGB PNG32:$1.png;
+  RET=$?
+fi
+
+if [ $RET -eq 124 ];
+then
+ echo "Image processing timed out!";
+ cp "$FAILED" $1.png
+ exit 1
+fi
+
+timeout 20 convert $1.png -bordercolor transparent -border 50 -background 'transparent' -flatten PNG32:$1.png;
+
+if [ $? -eq 124 ]; then
+  echo "Recoloring timed out!";
+  cp "$FAILED" $1.png
+  exit 1
+fi
+
+width=`convert $1.png -format "%[fx:w]" info:`
+minwidth=1000
+extra=$((minwidth-width))
+
+if [ $extra -gt 0 ]; then
+  timeout 20 convert $1.png -gravity East +antialias -splice ${extra}x -alpha set -background transparent -alpha Background -channel alpha -fx "i>${width}-5?0:a" +channel PNG32:$1.png;
+
+  if [ $? -eq 124 ]; then
+    echo "Padding timed out!";
+    cp "$FAILED" $1.png
+    exit 1
+  fi
+fi
\ No newline at end of file
@@ -0,0 +1,152 @@
+# MIT License
+#
+# Copyright (c) 2016-2023 AnonymousDapper
+#
+
+from __future__ import annotations
+
+__all__ = ("StagingManager",)
+
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager, suppress
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from ..logger import get_logger
+
+log = get_logger()
+
+
+# Prefer a RAM-backed filesystem for scratch space, since every render writes ~10 files
+def _scratch_root() -> Path:
+    shm = Path("/dev/shm")
+
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        return shm
+
+    return Path(tempfile.gettempdir())
+
+
+class StagingManager:
+    def __init__(
+        self,
+        root: str | Path,
+        *,
+        ttl: float = 7 * 24 * 60 * 60,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_entries: int = 2000,
+        interval: float = 60 * 60,
+        on_collect: Optional[Callable[[], Awaitable[Any]]] = None,
+    ):
+        self.root = Path(root).resolve()
+        self.scratch_root = _scratch_root()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.interval = interval
+
+        # Runs after each cleanup, to drop anything that pointed at removed renders
+        self.on_collect = on_collect
+
+        self._task: Optional[asyncio.Task] = None
+
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, uid: str | int) -> Path:
+        return self.root / str(uid)
+
+    def has(self, uid: str | int) -> bool:
+        return self.path(uid).is_dir()
+
+    # Temporary directory for a single render, removed once the render is done
+    @asynccontextmanager
+    async def scratch(self, uid: str | int) -> AsyncIterator[Path]:
+        path = Path(
+            await asyncio.to_thread(
+                tempfile.mkdtemp, prefix=f"snake-tex-{uid}-", dir=self.scratch_root
+            )
+        )
+
+        try:
+            yield path
+
+        finally:
+            await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
+
+    # Move the final artifacts of a render somewhere they'll outlive the scratch dir
+    async def keep(self, uid: str | int, *files: Path) -> list[Path]:
+        def _keep():
+            dest = self.path(uid)
+            dest.mkdir(parents=True, exist_ok=True)
+
+            return [Path(shutil.move(file, dest / file.name)) for file in files]
+
+        return await asyncio.to_thread(_keep)
+
+    # Drop expired renders, then the oldest ones until we're within budget
+    def _collect(self) -> tuple[int, int]:
+        entries = []
+        now = time.time()
+
+        for entry in self.root.iterdir():
+            if not entry.is_dir():
+                continue
+
+            with suppress(OSError):
+                files = [f.stat() for f in entry.iterdir()]
+                mtime = max((s.st_mtime for s in files), default=entry.stat().st_mtime)
+                entries.append((mtime, sum(s.st_size for s in files), entry))
+
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        removed = freed = 0
+
+        for mtime, size, entry in entries:
+            if (
+                now - mtime < self.ttl
+                and total <= self.max_bytes
+                and len(entries) - removed <= self.max_entries
+            ):
+                break
+
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            freed += size
+            removed += 1
+
+        return removed, freed
+
+    async def collect(self) -> tuple[int, int]:
+        removed, freed = await asyncio.to_thread(self._collect)
+
+        if removed:
+            log.info(f"Removed {removed} staged renders ({freed} bytes)")
+
+        if self.on_collect is not None:
+            await self.on_collect()
+
+        return removed, freed
+
+    async def _run(self):
+        while True:
+            try:
+                await self.collect()
+
+            except Exception as e:
+                log.error(f"Staging cleanup failed: [{type(e).__name__}]: {e}")
+
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
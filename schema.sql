@@ -1,4 +1,4 @@
-CREATE TABLE boards (
+CREATE TABLE IF NOT EXISTS boards (
     id INTEGER PRIMARY KEY,
     guild_id INTEGER NOT NULL,
     channel_id INTEGER UNIQUE NOT NULL,
@@ -7,7 +7,7 @@ CREATE TABLE boards (
     emote TEXT NOT NULL
 );
 
-CREATE TABLE board_messages (
+CREATE TABLE IF NOT EXISTS board_messages (
     message_id INTEGER PRIMARY KEY,
     channel_id INTEGER NOT NULL,
     guild_id INTEGER NOT NULL,
@@ -20,7 +20,7 @@ CREATE TABLE board_messages (
 );
 
 
-CREATE TABLE posted_board_messages (
+CREATE TABLE IF NOT EXISTS posted_board_messages (
     message_id INTEGER PRIMARY KEY,
     board_message_id INTEGER NOT NULL,
 
@@ -28,10 +28,34 @@ CREATE TABLE posted_board_messages (
         ON DELETE CASCADE ON UPDATE NO ACTION
 );
 
-CREATE TABLE autoroles (
+CREATE TABLE IF NOT EXISTS autoroles (
     role_id INTEGER PRIMARY KEY,
     guild_id INTEGER NOT NULL,
     channel_id INTEGER NOT NULL,
     message_id INTEGER NOT NULL,
     emote TEXT NOT NULL
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS latex_renders (
+    message_id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    source_hash TEXT NOT NULL,
+    cache_key TEXT NOT NULL,
+    staging_path TEXT NOT NULL,
+    source TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS latex_renders_cache_key ON latex_renders(cache_key);
+
+-- Hourly per-command rollups; `counts` holds msgpack-encoded latency histogram buckets
+CREATE TABLE IF NOT EXISTS command_stats (
+    bucket INTEGER NOT NULL,
+    command TEXT NOT NULL,
+    errors INTEGER NOT NULL,
+    total_ms REAL NOT NULL,
+    max_ms REAL NOT NULL,
+    counts BLOB NOT NULL,
+
+    PRIMARY KEY(bucket, command)
+) WITHOUT ROWID;
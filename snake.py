@@ -6,8 +6,14 @@
 
 from __future__ import annotations
 
+import argparse
 import asyncio
+import gc
+import logging
+import resource
+import signal
 import sys
+import time
 from pathlib import Path
 from typing import Literal, Optional, Union
 
@@ -19,7 +25,17 @@ import tomli
 from discord.ext import commands
 
 from cogs.utils import logger
+from cogs.utils.cluster import (
+    LAUNCHER,
+    ClusterInfo,
+    ClusterLauncher,
+    IPCClient,
+    IPCMessage,
+)
 from cogs.utils.colors import Colorize as C
+from cogs.utils.monitor import LoopMonitor
+from cogs.utils.prometheus import MetricsServer
+from cogs.utils.rest import RestTracker
 from cogs.utils.sql import SQL, Emote
 
 clogger = logger.get_console_logger("snake")
@@ -45,6 +61,73 @@ def _read_config(filename):
 
 _CREDS = _read_config("credentials.toml")
 
+# Cluster workers always shard; a single process only does when configured to
+_SHARDED = "--cluster-id" in sys.argv or _read_config("config.toml").get(
+    "Sharding", {}
+).get("enabled", False)
+
+# What the feature cogs actually use: message content for boards and commands,
+# reactions for boards/autoroles, emojis to resolve board emotes
+MINIMAL_INTENTS = dict(
+    guilds=True,
+    guild_messages=True,
+    dm_messages=True,
+    message_content=True,
+    guild_reactions=True,
+    dm_reactions=True,
+    emojis_and_stickers=True,
+)
+
+
+# Build the client's intents and cache options from the [Intents] and [Cache] config
+def _client_options(config: dict) -> dict:
+    intent_config = dict(config.get("Intents", {}))
+    profile = intent_config.pop("profile", "all")
+
+    if profile == "all":
+        intents = discord.Intents.all()
+
+    elif profile == "default":
+        intents = discord.Intents.default()
+
+    elif profile == "minimal":
+        intents = discord.Intents(**MINIMAL_INTENTS)
+
+    else:
+        raise ValueError(f"Unknown intents profile {profile!r}")
+
+    # Any other key overrides a single flag of the profile
+    for flag, value in intent_config.items():
+        if flag not in discord.Intents.VALID_FLAGS:
+            raise ValueError(f"Unknown intent {flag!r}")
+
+        setattr(intents, flag, value)
+
+    cache_config = config.get("Cache", {})
+    member_cache = cache_config.get("members", "intents")
+
+    if member_cache == "intents":
+        member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+
+    elif member_cache == "none":
+        member_cache_flags = discord.MemberCacheFlags.none()
+
+    elif member_cache == "all":
+        member_cache_flags = discord.MemberCacheFlags.all()
+
+    else:
+        raise ValueError(f"Unknown member cache policy {member_cache!r}")
+
+    return dict(
+        intents=intents,
+        member_cache_flags=member_cache_flags,
+        max_messages=cache_config.get("max_messages", 1000) or None,
+        chunk_guilds_at_startup=cache_config.get(
+            "chunk_guilds_at_startup", intents.members
+        ),
+    )
+
+
 logger.set_level(debug=_DEBUG)
 
 
@@ -55,9 +138,10 @@ class Builtin(commands.Cog):
     @commands.command(name="quit", brief="exit bot", aliases=["×"])
     @commands.is_owner()
     async def quit_command(self, ctx: commands.Context):
-        await self.bot.myst_client.close()
-        await self.bot.aio_session.close()
-        await self.bot.db.close()
+        # In a cluster, the launcher stops every worker (this one included)
+        if self.bot.ipc:
+            await self.bot.ipc.send("shutdown", target=LAUNCHER)
+
         await self.bot.close()
 
     @commands.group(
@@ -77,12 +161,13 @@ class Builtin(commands.Cog):
 
         else:
             try:
-                await self.bot.load_extension(cog_name)
+                await self.bot.load_cog(name.lower())
 
             except Exception as e:
                 await ctx.send(f"Failed to load {name}: [{type(e).__name__}]: `{e}`")
 
             else:
+                await self.bot.broadcast_cog("load", name.lower())
                 await self.bot.post_reaction(ctx.message, success=True)
 
     @manage_cogs.command(name="unload", brief="unload cog", aliases=["-"])
@@ -101,6 +186,7 @@ class Builtin(commands.Cog):
                 await ctx.send(f"Failed to unload {name}: [{type(e).__name__}]: `{e}`")
 
             else:
+                await self.bot.broadcast_cog("unload", name.lower())
                 await self.bot.post_reaction(ctx.message, success=True)
 
     @manage_cogs.command(name="reload", brief="reload cog", aliases=["*"])
@@ -114,12 +200,13 @@ class Builtin(commands.Cog):
         else:
             try:
                 await self.bot.unload_extension(cog_name)
-                await self.bot.load_extension(cog_name)
+                await self.bot.load_cog(name.lower())
 
             except Exception as e:
                 await ctx.send(f"Failed to reload {name}: [{type(e).__name__}]: `{e}`")
 
             else:
+                await self.bot.broadcast_cog("reload", name.lower())
                 await self.bot.post_reaction(ctx.message, success=True)
 
     @manage_cogs.command(name="list", brief="list loaded cogs", aliases=["~"])
@@ -139,6 +226,42 @@ class Builtin(commands.Cog):
             else:
                 await self.bot.post_reaction(ctx.message, success=True)
 
+    @manage_cogs.command(name="timings", brief="cog load timings")
+    @commands.is_owner()
+    async def show_cog_timings(self, ctx: commands.Context):
+        await ctx.send(f"```prolog\n{self.bot.cog_report()}\n```")
+
+    # Compare cache footprints between intents/cache profiles
+    @commands.command(name="memory", brief="memory and cache report")
+    @commands.is_owner()
+    async def memory_report(self, ctx: commands.Context):
+        bot = self.bot
+
+        try:
+            with open("/proc/self/statm") as f:
+                rss = int(f.read().split()[1]) * resource.getpagesize()
+
+        except OSError:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        members = sum(len(guild.members) for guild in bot.guilds)
+        enabled = [name for name, value in bot.intents if value]
+
+        await ctx.send(
+            "```prolog\n"
+            f"RSS          = {rss / 1048576:.1f} MiB (peak {peak / 1048576:.1f} MiB)\n"
+            f"GC objects   = {len(gc.get_objects())}\n"
+            f"Guilds       = {len(bot.guilds)}\n"
+            f"Members      = {members}\n"
+            f"Users        = {len(bot.users)}\n"
+            f"Messages     = {len(bot.cached_messages)} / {bot.client_options['max_messages']}\n"
+            f"Emojis       = {len(bot.emojis)}\n"
+            f"Member cache = {bot.client_options['member_cache_flags']!r}\n"
+            f"Intents      = {', '.join(enabled)}\n"
+            "```"
+        )
+
     @commands.command(name="sync", brief="sync slash commands", aliases=["§"])
     @commands.guild_only()
     @commands.is_owner()
@@ -178,20 +301,62 @@ class Builtin(commands.Cog):
         await ctx.send(f"Synced global tree to {ret}/{len(guilds)}.")
 
 
-class SnakeBot(commands.Bot):
-    def __init__(self, *args, **kwargs):
+class SnakeBot(commands.AutoShardedBot if _SHARDED else commands.Bot):
+    def __init__(self, *args, cluster: Optional[ClusterInfo] = None, **kwargs):
         self.debug = _DEBUG
+        self.cluster = cluster
+        self.ipc = cluster and IPCClient(cluster.ipc_path, cluster.id)
         self.loop = asyncio.get_event_loop()
 
         self.log = clogger
 
         self.config = _read_config("config.toml")
 
-        self.db = SQL(db_file=Path(self.config["SQLite"]["file_path"]))
+        log_config = self.config.get("Logging", {})
+        if log_config.get("structured", False):
+            logger.enable_structured(
+                max_bytes=log_config.get("structured_max_mb", 16) * 1024 * 1024,
+                interval=log_config.get("structured_rotate_hours", 24) * 60 * 60,
+                backup_count=log_config.get("structured_backups", 14),
+            )
+
+        self.db = SQL(
+            db_file=Path(self.config["SQLite"]["file_path"]),
+            schema_file=Path("schema.sql"),
+            slow_query_ms=self.config["SQLite"].get("slow_query_ms", 100.0),
+            slow_maintenance_ms=self.config["SQLite"].get(
+                "slow_maintenance_ms", 60000.0
+            ),
+            busy_timeout_ms=self.config["SQLite"].get("busy_timeout_ms", 5000),
+            wal=cluster is not None,
+        )
+
+        monitor_config = self.config.get("Monitor", {})
+        self.monitor = LoopMonitor(
+            self,
+            interval=monitor_config.get("interval", 0.5),
+            stall_threshold=monitor_config.get("stall_ms", 500) / 1000,
+            gateway_interval=monitor_config.get("gateway_interval", 30.0),
+        )
+
+        metrics_config = self.config.get("Metrics", {})
+        self.metrics_server = None
+        if metrics_config.get("enabled", False):
+            self.metrics_server = MetricsServer(
+                self,
+                host=metrics_config.get("host", "127.0.0.1"),
+                port=metrics_config.get("port", 9464) + (cluster and cluster.id or 0),
+            )
 
         # Load credentials
         self.token = _CREDS["Discord"]["token"]
 
+        # Per-cog (import, setup) seconds from the last load
+        self.cog_timings: dict[str, tuple[float, float]] = {}
+        self._load_started: dict[str, float] = {}
+        self._import_times: dict[str, float] = {}
+        self._setup_times: dict[str, float] = {}
+
         self.start_time = None
         self.resume_time = None
 
@@ -199,6 +364,17 @@ class SnakeBot(commands.Bot):
             command_attrs=dict(hidden=True),
         )
 
+        if cluster:
+            kwargs.update(shard_ids=cluster.shard_ids, shard_count=cluster.shard_count)
+
+        elif _SHARDED:
+            kwargs.update(
+                shard_count=self.config.get("Sharding", {}).get("shard_count") or None
+            )
+
+        # Kept for the memory report, the client doesn't expose all of these
+        self.client_options = _client_options(self.config)
+
         # Init superclass
         super().__init__(
             *args,
@@ -206,36 +382,190 @@ class SnakeBot(commands.Bot):
             help_command=help_cmd,
             description="\nHsss!\n",
             command_prefix=self.get_prefix,  # type: ignore
-            intents=discord.Intents.all(),
+            **self.client_options,
+        )
+
+        self.rest = RestTracker(
+            window_minutes=monitor_config.get("rest_window_minutes", 60),
+            passthrough_level=logging.DEBUG if self.debug else logging.INFO,
         )
+        self.rest.install(self.http)
 
         self.boot_time = arrow.utcnow()
 
+    # Cluster 0 (or the only process) runs the jobs that must not run once per cluster
+    @property
+    def is_primary(self) -> bool:
+        return self.cluster is None or self.cluster.id == 0
+
+    # Whether this process runs the shard a guild lives on
+    def owns_guild(self, guild_id: int) -> bool:
+        if self.cluster is None:
+            return True
+
+        return (guild_id >> 22) % self.cluster.shard_count in self.cluster.shard_ids
+
     async def setup_hook(self):
+        self.monitor.start()
+
+        # The cluster launcher stops workers with SIGTERM, which should shut down like quit
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.create_task(self.close())
+        )
+
+        if self.ipc:
+            self.ipc.on("cog")(self.on_ipc_cog)
+            await self.ipc.connect()
+
         await self.db._setup()
 
         self.aio_session = aiohttp.ClientSession()
 
         self.myst_client = mystbin.Client(session=self.aio_session)
 
+        if self.metrics_server:
+            await self.metrics_server.start()
+
         await self.add_cog(Builtin(self))
 
-        for file in Path("cogs/").iterdir():
-            if (
-                file.is_file()
-                and file.suffix == ".py"
-                and not file.stem.startswith("_")
-            ):
-                stem = file.stem
-                try:
-                    await self.load_extension(f"cogs.{stem}")
-                except Exception as e:
-                    self.log.warn(
-                        f"Failed to load cog {C(stem).bright_red()}: [{type(e).__name__}]: {e}",
-                        exc_info=True,
-                    )
-                else:
-                    self.log.info(f"Loaded cog {C(stem).green()}")
+        startup_config = self.config.get("Startup", {})
+        deferred = set(startup_config.get("deferred_cogs", []))
+
+        stems = [
+            file.stem
+            for file in sorted(Path("cogs/").iterdir())
+            if file.is_file() and file.suffix == ".py" and not file.stem.startswith("_")
+        ]
+        eager = [stem for stem in stems if stem not in deferred]
+
+        started = time.perf_counter()
+
+        # Imports still run one at a time, but setup/cog_load awaits overlap
+        if startup_config.get("concurrent", True):
+            await asyncio.gather(*map(self.try_load_cog, eager))
+
+        else:
+            for stem in eager:
+                await self.try_load_cog(stem)
+
+        self.log.info(
+            f"Loaded {len(eager)} cogs in {(time.perf_counter() - started) * 1000:.1f}ms\n{self.cog_report()}"
+        )
+
+        # Deferred cogs aren't needed to connect, so they load once the gateway is up
+        if deferred_stems := [stem for stem in stems if stem in deferred]:
+            self._deferred_load = asyncio.create_task(
+                self.load_deferred_cogs(deferred_stems)
+            )
+
+    # Time spent in add_cog (setup/cog_load), keyed by the cog's module
+    # Nothing yields between load_extension starting and setup() calling this, so the
+    # import span is exact. The setup span is wall-clock, and overlaps other cogs' loads
+    # when they run concurrently
+    async def add_cog(self, cog: commands.Cog, /, **kwargs):
+        started = time.perf_counter()
+        module = type(cog).__module__
+
+        if (load_started := self._load_started.pop(module, None)) is not None:
+            self._import_times[module] = started - load_started
+
+        await super().add_cog(cog, **kwargs)
+
+        self._setup_times[module] = self._setup_times.get(module, 0.0) + (
+            time.perf_counter() - started
+        )
+
+    # Load a cog, returning its (import, setup) time in seconds
+    async def load_cog(self, stem: str) -> tuple[float, float]:
+        name = f"cogs.{stem}"
+        self._import_times.pop(name, None)
+        self._setup_times.pop(name, None)
+
+        started = self._load_started[name] = time.perf_counter()
+
+        try:
+            await self.load_extension(name)
+
+        finally:
+            self._load_started.pop(name, None)
+
+        import_time = self._import_times.pop(name, time.perf_counter() - started)
+        self.cog_timings[stem] = (import_time, self._setup_times.pop(name, 0.0))
+
+        return self.cog_timings[stem]
+
+    async def try_load_cog(self, stem: str):
+        try:
+            import_time, setup_time = await self.load_cog(stem)
+
+        except Exception as e:
+            self.log.warn(
+                f"Failed to load cog {C(stem).bright_red()}: [{type(e).__name__}]: {e}",
+                exc_info=True,
+            )
+
+        else:
+            self.log.info(
+                f"Loaded cog {C(stem).green()} in {(import_time + setup_time) * 1000:.1f}ms"
+            )
+
+    async def load_deferred_cogs(self, stems: list[str]):
+        await self.wait_until_ready()
+
+        for stem in stems:
+            await self.try_load_cog(stem)
+
+    def cog_report(self) -> str:
+        lines = [f"{'cog':<14} {'import':>9} {'setup*':>9}"]
+
+        for stem, (import_time, setup_time) in sorted(
+            self.cog_timings.items(), key=lambda i: -sum(i[1])
+        ):
+            lines.append(
+                f"{stem:<14} {import_time * 1000:>7.1f}ms {setup_time * 1000:>7.1f}ms"
+            )
+
+        lines.append("* wall-clock, overlaps between cogs loaded concurrently")
+
+        return "\n".join(lines)
+
+    # Mirror an owner's cog load/unload/reload from another cluster
+    async def on_ipc_cog(self, message: IPCMessage):
+        action, stem = message.data["action"], message.data["name"]
+
+        try:
+            if action in ("unload", "reload"):
+                await self.unload_extension(f"cogs.{stem}")
+
+            if action in ("load", "reload"):
+                await self.load_cog(stem)
+
+        except Exception as e:
+            self.log.warn(
+                f"Cluster {message.sender} asked to {action} {stem}, failed: [{type(e).__name__}]: {e}"
+            )
+
+    async def broadcast_cog(self, action: str, stem: str):
+        if self.ipc:
+            await self.ipc.send("cog", action=action, name=stem)
+
+    async def close(self):
+        self.monitor.stop()
+
+        if self.ipc:
+            await self.ipc.close()
+
+        if self.metrics_server:
+            await self.metrics_server.stop()
+
+        await super().close()
+
+        # Cogs still flush to the database and post pastes while unloading
+        if hasattr(self, "aio_session"):
+            await self.myst_client.close()
+            await self.aio_session.close()
+
+        await self.db.close()
 
     # Post a reaction indicating command status
     async def post_reaction(
@@ -291,6 +621,9 @@ class SnakeBot(commands.Bot):
 
         await self.change_presence(activity=act)
 
+        if self.ipc:
+            await self.ipc.send("ready", target=LAUNCHER)
+
     async def on_resume(self):
         self.resume_time = arrow.utcnow()
         boot_duration = self.resume_time.humanize(
@@ -328,7 +661,41 @@ class SnakeBot(commands.Bot):
 
 
 def main():
-    bot = SnakeBot()
+    parser = argparse.ArgumentParser(description="Robosnake for discord")
+    parser.add_argument("-d", action="store_true", help="debug mode")
+    parser.add_argument(
+        "--cluster", action="store_true", help="run the cluster launcher"
+    )
+    parser.add_argument("--cluster-id", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--shard-ids", help=argparse.SUPPRESS)
+    parser.add_argument("--shard-count", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--ipc", help=argparse.SUPPRESS)
+    args, _ = parser.parse_known_args()
+
+    if args.cluster:
+        cluster_config = _read_config("config.toml").get("Cluster", {})
+        launcher = ClusterLauncher(
+            _CREDS["Discord"]["token"],
+            clusters=cluster_config.get("clusters", 2),
+            shard_count=cluster_config.get("shard_count", 0),
+            socket_path=cluster_config.get("socket", "snake-cluster.sock"),
+            ready_timeout=cluster_config.get("ready_timeout", 120.0),
+            extra_args=["-d"] if _DEBUG else [],
+        )
+
+        asyncio.run(launcher.run())
+        return
+
+    cluster = None
+    if args.cluster_id is not None:
+        cluster = ClusterInfo(
+            args.cluster_id,
+            [int(shard) for shard in args.shard_ids.split(",")],
+            args.shard_count,
+            args.ipc,
+        )
+
+    bot = SnakeBot(cluster=cluster)
     bot.run(bot.token)
 
 